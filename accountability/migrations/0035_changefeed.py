@@ -0,0 +1,78 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("accountability", "0034_accountobject_comments"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Tombstone",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "collection",
+                    models.CharField(
+                        choices=[
+                            ("disbursements", "Desembolsos"),
+                            ("reports", "Rendiciones"),
+                            ("receipts", "Comprobantes"),
+                        ],
+                        max_length=20,
+                        verbose_name="colección",
+                    ),
+                ),
+                (
+                    "object_id",
+                    models.PositiveBigIntegerField(verbose_name="id del registro"),
+                ),
+                (
+                    "deleted_at",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="eliminado el"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "registro eliminado",
+                "verbose_name_plural": "registros eliminados",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="disbursement",
+            index=models.Index(
+                fields=["updated_at", "id"], name="accountabil_updated_087899_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="receipt",
+            index=models.Index(
+                fields=["updated_at", "id"], name="accountabil_updated_c4f1c6_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="report",
+            index=models.Index(
+                fields=["updated_at", "id"], name="accountabil_updated_ed1799_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tombstone",
+            index=models.Index(
+                fields=["collection", "deleted_at", "object_id"],
+                name="accountabil_collect_3e536f_idx",
+            ),
+        ),
+    ]
@@ -6,6 +6,9 @@ from django.db import models
 from dateutil.relativedelta import relativedelta
 from django.db.models.functions import Coalesce
 from django.dispatch import receiver
+from django.utils import timezone
+
+from core.cache import invalidate
 
 logger = logging.getLogger(__name__)
 
@@ -136,6 +139,7 @@ class Disbursement(models.Model):
     class Meta:
         verbose_name = "desembolso"
         verbose_name_plural = "desembolsos"
+        indexes = [models.Index(fields=["updated_at", "id"])]
 
     def __str__(self):
         try:
@@ -215,6 +219,7 @@ class Report(models.Model):
     class Meta:
         verbose_name = "rendición"
         verbose_name_plural = "rendiciones"
+        indexes = [models.Index(fields=["updated_at", "id"])]
 
     def __str__(self):
         try:
@@ -277,6 +282,29 @@ class ReceiptManager(models.Manager):
             )
         )
 
+    def without_totals(self):
+        """Receipts without the grouped ``receipt_total`` annotation"""
+        return super().get_queryset()
+
+    def with_total_subquery(self):
+        """
+        Receipts whose ``receipt_total`` is a correlated subquery, computed only
+        for the rows actually fetched instead of grouping the whole table.
+        """
+        return self.without_totals().annotate(
+            receipt_total=models.Subquery(
+                ReceiptItem.objects.filter(receipt=models.OuterRef("pk"))
+                .values("receipt")
+                .annotate(
+                    total=models.Sum(
+                        models.F("unit_price") * models.F("quantity"),
+                        output_field=models.FloatField(),
+                    )
+                )
+                .values("total")
+            )
+        )
+
 
 def validate_ruc(value):
     if len(value) < 4:
@@ -352,6 +380,7 @@ class Receipt(models.Model):
     class Meta:
         verbose_name = "comprobante"
         verbose_name_plural = "comprobantes"
+        indexes = [models.Index(fields=["updated_at", "id"])]
 
     def __str__(self):
         return f"{self.receipt_type} nro. {self.receipt_number}"
@@ -411,6 +440,85 @@ class ReceiptItem(models.Model):
         super().save(*args, **kwargs)
 
 
+class Tombstone(models.Model):
+    """Records deleted rows so that the change feed can report deletions"""
+
+    class Collection(models.TextChoices):
+        disbursements = "disbursements", "Desembolsos"
+        reports = "reports", "Rendiciones"
+        receipts = "receipts", "Comprobantes"
+
+    collection = models.CharField(
+        max_length=20, choices=Collection.choices, verbose_name="colección"
+    )
+    object_id = models.PositiveBigIntegerField(verbose_name="id del registro")
+    deleted_at = models.DateTimeField(auto_now_add=True, verbose_name="eliminado el")
+
+    class Meta:
+        verbose_name = "registro eliminado"
+        verbose_name_plural = "registros eliminados"
+        indexes = [models.Index(fields=["collection", "deleted_at", "object_id"])]
+
+    def __str__(self):
+        return f"{self.get_collection_display()} {self.object_id}"
+
+
+def report_total_subquery(report_ref: str = "pk"):
+    """
+    Total of the receipt items of the report referenced by ``report_ref`` in
+    the outer query, as a correlated subquery
+    """
+    return models.Subquery(
+        ReceiptItem.objects.filter(receipt__report=models.OuterRef(report_ref))
+        .values("receipt__report")
+        .annotate(
+            total=models.Sum(
+                models.F("unit_price") * models.F("quantity"),
+                output_field=models.FloatField(),
+            )
+        )
+        .values("total")
+    )
+
+
+def update_reports_status(report_ids):
+    """
+    Marks as finished the pending reports whose receipts cover the disbursed
+    amount, computing every report total in a single query.
+    """
+    updated = (
+        Report.objects.filter(
+            id__in=report_ids,
+            status=Report.ReportStatus.pending.value,
+            disbursement__amount_disbursed__isnull=False,
+        )
+        .annotate(reported=report_total_subquery())
+        .filter(reported__gte=models.F("disbursement__amount_disbursed"))
+        .update(status=Report.ReportStatus.finished.value, updated_at=timezone.now())
+    )
+    if updated:
+        invalidate(Report)
+    return updated
+
+
+def touch_receipts(receipt_ids):
+    """
+    Moves the receipts forward in the change feed after their items change,
+    since the feed publishes each receipt with its items and total
+    """
+    return (
+        Receipt.objects.without_totals()
+        .filter(id__in=receipt_ids)
+        .update(updated_at=timezone.now())
+    )
+
+
+@receiver(models.signals.post_save, sender=ReceiptItem)
+@receiver(models.signals.post_delete, sender=ReceiptItem)
+def touch_item_receipt(sender, instance, **kwargs):
+    touch_receipts([instance.receipt_id])
+
+
 @receiver(models.signals.post_save, sender=Receipt)
 def update_report_status(sender, instance, **kwargs):
     try:
@@ -424,3 +532,45 @@ def update_report_status(sender, instance, **kwargs):
     except Exception as e:
         logger.error(f"No se pudo actualizar el reporte. {e}", exc_info=True)
         pass
+
+
+TOMBSTONE_COLLECTIONS = {
+    Disbursement: Tombstone.Collection.disbursements,
+    Report: Tombstone.Collection.reports,
+    Receipt: Tombstone.Collection.receipts,
+}
+
+
+@receiver(models.signals.post_delete, sender=Disbursement)
+@receiver(models.signals.post_delete, sender=Report)
+@receiver(models.signals.post_delete, sender=Receipt)
+def record_tombstone(sender, instance, **kwargs):
+    Tombstone.objects.create(
+        collection=TOMBSTONE_COLLECTIONS[sender], object_id=instance.pk
+    )
+
+
+@receiver(models.signals.post_save, sender=Resolution)
+@receiver(models.signals.post_delete, sender=Resolution)
+@receiver(models.signals.post_save, sender=DisbursementOrigin)
+@receiver(models.signals.post_delete, sender=DisbursementOrigin)
+@receiver(models.signals.post_save, sender=OriginDetail)
+@receiver(models.signals.post_delete, sender=OriginDetail)
+@receiver(models.signals.post_save, sender=PaymentType)
+@receiver(models.signals.post_delete, sender=PaymentType)
+@receiver(models.signals.post_save, sender=ReceiptType)
+@receiver(models.signals.post_delete, sender=ReceiptType)
+@receiver(models.signals.post_save, sender=Provider)
+@receiver(models.signals.post_delete, sender=Provider)
+@receiver(models.signals.post_save, sender=AccountObject)
+@receiver(models.signals.post_delete, sender=AccountObject)
+@receiver(models.signals.post_save, sender=Disbursement)
+@receiver(models.signals.post_delete, sender=Disbursement)
+@receiver(models.signals.post_save, sender=Report)
+@receiver(models.signals.post_delete, sender=Report)
+@receiver(models.signals.post_save, sender=Receipt)
+@receiver(models.signals.post_delete, sender=Receipt)
+@receiver(models.signals.post_save, sender=ReceiptItem)
+@receiver(models.signals.post_delete, sender=ReceiptItem)
+def invalidate_cached_aggregates(sender, **kwargs):
+    invalidate(sender)
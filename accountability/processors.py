@@ -1,10 +1,11 @@
-import io
 import logging
 import re
 from datetime import datetime
-from typing import IO
+from itertools import islice
+from typing import IO, Callable
 
 from dateutil.relativedelta import relativedelta
+from django.db import transaction
 from openpyxl import load_workbook
 
 from accountability.models import (
@@ -18,7 +19,11 @@ from accountability.models import (
     AccountObject,
     Receipt,
     ReceiptItem,
+    touch_receipts,
+    update_reports_status,
 )
+from core.cache import invalidate
+from core.instrumentation import ImportStats
 from core.models import Institution
 
 logger = logging.getLogger(__name__)
@@ -29,13 +34,22 @@ class ExcelProcessor:
         def __init__(self, message):
             self.message = f"Error processing file: {message}"
 
-    def __init__(self, file: IO, sheet_name="General"):
-        _file = io.BytesIO(file.read())
-        self.workbook = load_workbook(filename=_file, data_only=True)
+    # data starts after the three header rows and spans columns A to AB
+    FIRST_ROW = 4
+    COLUMNS = 28
+    PAYMENT_TYPES = ("Cheque", "Transferencia bancaria", "Otro")
+    RECEIPT_BATCH_SIZE = 500
+
+    def __init__(
+        self,
+        file: IO,
+        sheet_name="General",
+        progress: Callable[[int, int], None] | None = None,
+    ):
+        # read-only workbooks stream rows from the file instead of loading the
+        # whole sheet in memory
+        self.workbook = load_workbook(filename=file, read_only=True, data_only=True)
         self.sheet = self.workbook[sheet_name]
-        dimensions = self.sheet.dimensions
-        _, last_cell = dimensions.split(":")
-        self.last_row = int(re.search(r"\d+", last_cell).group())
         self.institution = None
         self.resolution = None
         self.disbursement = None
@@ -46,71 +60,215 @@ class ExcelProcessor:
         self.report_status = None
         self.disbursement_date = None
         self.payment_type = None
+        self.payment_types = {}
+        self.disbursement_origins = {}
+        self.origin_detail_names = {}
+        self.receipt_types = {}
+        self.account_objects = {}
+        self.institutions = {}
+        self.pending_items = []
+        self.progress = progress
+        self.rows_processed = 0
+        self.skipped_rows = []
+        self.stats = ImportStats()
 
-    def process(self):
+    def iter_rows(self):
+        return self.sheet.iter_rows(
+            min_row=self.FIRST_ROW, max_col=self.COLUMNS, values_only=True
+        )
+
+    def iter_data_rows(self):
+        """
+        Yields the index and values of the non-empty rows, stopping at the
+        first two consecutive empty rows that mark the end of the data
+        """
         empty_row_count = 0
-        all_rows = [row for row in self.sheet.rows]
-        for idx, row in enumerate(all_rows[3:485]):
-            logger.info(f"Processing row {idx + 1}")
+        for idx, row in enumerate(self.iter_rows()):
             if all(cell is None for cell in row):
                 empty_row_count += 1
                 if empty_row_count >= 2:
-                    break
+                    return
+                continue
             empty_row_count = 0
-            try:
-                self.get_or_create_report(row)
-            except Exception as e:
-                logger.info(f"Error in line {idx + 1}: {e}", exc_info=True)
+            yield idx, row
+
+    def close(self):
+        self.workbook.close()
+
+    @staticmethod
+    def _normalize_code(value) -> str:
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value).strip()
+
+    @staticmethod
+    def _normalize_name(value) -> str:
+        return " ".join(str(value).split()).casefold()
+
+    @staticmethod
+    def _to_text(value) -> str:
+        """Stripped text of a cell; dates and empty cells give an empty string"""
+        if value is None or isinstance(value, datetime):
+            return ""
+        return str(value).strip()
+
+    @staticmethod
+    def _to_int(value) -> int | None:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _load(queryset, key) -> dict:
+        """Indexes a queryset by key, keeping the first object of duplicates"""
+        lookup = {}
+        for obj in queryset:
+            lookup.setdefault(key(obj), obj)
+        return lookup
+
+    @staticmethod
+    def _create_missing(model, lookup: dict, field: str, values: set):
+        missing = [model(**{field: value}) for value in values if value not in lookup]
+        for obj in model.objects.bulk_create(missing):
+            lookup[getattr(obj, field)] = obj
+        if missing:
+            invalidate(model)
+
+    def load_references(self):
+        """
+        Loads the reference tables into memory so that rows are resolved with
+        dictionary lookups. Values missing from them are created batch by
+        batch by ``create_references``.
+        """
+        self.payment_types = self._load(PaymentType.objects.all(), lambda o: o.name)
+        self._create_missing(
+            PaymentType, self.payment_types, "name", set(self.PAYMENT_TYPES)
+        )
+        self.disbursement_origins = self._load(
+            DisbursementOrigin.objects.all(), lambda o: o.code
+        )
+        self.origin_detail_names = self._load(
+            OriginDetail.objects.all(), lambda o: o.name
+        )
+        self.receipt_types = self._load(ReceiptType.objects.all(), lambda o: o.name)
+        self.account_objects = self._load(
+            AccountObject.objects.order_by("id"), lambda o: o.key
+        )
+        self.institutions = self._load(
+            Institution.objects.select_related("establishment").only(
+                "id", "code", "name", "establishment__code"
+            ),
+            lambda o: (
+                o.establishment.code,
+                o.code,
+                self._normalize_name(o.name),
+            ),
+        )
+
+    def create_references(self, rows):
+        """
+        Creates the origins, origin details and receipt types used by a batch
+        of rows that do not exist yet, with a single insert per table
+        """
+        origin_codes, origin_details, receipt_types = set(), set(), set()
+        for _, row in rows:
+            if (code := self._to_int(row[11])) is not None:
+                origin_codes.add(code)
+            if origin_detail := self._to_text(row[12]):
+                origin_details.add(origin_detail)
+            if receipt_type := self._receipt_type_name(row):
+                receipt_types.add(receipt_type)
+        self._create_missing(
+            DisbursementOrigin, self.disbursement_origins, "code", origin_codes
+        )
+        self._create_missing(
+            OriginDetail, self.origin_detail_names, "name", origin_details
+        )
+        self._create_missing(ReceiptType, self.receipt_types, "name", receipt_types)
+
+    def iter_batches(self):
+        """Yields the data rows in lists of up to ``RECEIPT_BATCH_SIZE`` rows"""
+        rows = self.stats.timed_iter("read", self.iter_data_rows())
+        while batch := list(islice(rows, self.RECEIPT_BATCH_SIZE)):
+            yield batch
+
+    def process(self):
+        with self.stats.track_queries():
+            with self.stats.stage("load_references"):
+                self.load_references()
+            self.process_rows()
+        logger.info(
+            f"Finished processing {self.rows_processed} rows. "
+            f"Skipped {len(self.skipped_rows)} rows."
+        )
+        logger.info(f"Import stats: {self.stats.as_json()}")
+        return self.skipped_rows
+
+    def process_rows(self):
+        """
+        Reads the sheet once, in batches: the references of each batch are
+        created before its rows are processed and its items are written after
+        """
+        for batch in self.iter_batches():
+            with self.stats.stage("create_references"):
+                self.create_references(batch)
+            for idx, row in batch:
+                self.process_row(idx, row)
+            self.flush_receipts()
+
+    def process_row(self, idx: int, row):
+        logger.debug(f"Processing row {idx + 1}")
+        self.rows_processed += 1
+        try:
+            with self.stats.stage("reports"):
+                report = self.get_or_create_report(row)
+            with self.stats.stage("receipts"):
+                self.process_receipt(row, report)
+        except Exception as e:
+            logger.info(f"Error in line {idx + 1}: {e}", exc_info=True)
+            self.skipped_rows.append((idx + self.FIRST_ROW, str(e)))
+        if self.progress:
+            self.progress(self.rows_processed, len(self.skipped_rows))
 
     def get_institution(self, row):
-        code = row[1].value
-        establishment_code = row[0].value
-        name = row[3].value.strip()
-        if not code or not establishment_code:
+        if not row[1] or not row[0]:
             return self.institution
+        code = self._normalize_code(row[1])
+        establishment_code = self._normalize_code(row[0])
         if self.institution and (
             self.institution.code == code
             and self.institution.establishment.code == establishment_code
         ):
             return self.institution
-        try:
-            self.institution = Institution.objects.get(
-                code=code, establishment__code=establishment_code, name=name
-            )
-            return self.institution
-        except Institution.DoesNotExist:
-            logger.info(
-                f"Institution with code {row[1].value}, establishment code {row[0].value} does not exist."
-            )
-            return None
-        except Institution.MultipleObjectsReturned:
-            try:
-                self.institution = Institution.objects.get(
-                    code=code, establishment__code=establishment_code, name=row[3].value
-                )
-            except Institution.DoesNotExist:
-                pass
+        institution = self.institutions.get(
+            (establishment_code, code, self._normalize_name(row[3] or ""))
+        )
+        self.stats.cache("institutions", institution is not None)
+        if not institution:
             logger.info(
-                f"Institution with name={name}, code {row[1].value}, establishment code {row[0].value} does not exist"
+                f"Institution with name={row[3]}, code {row[1]}, establishment code {row[0]} does not exist."
             )
             return None
+        self.institution = institution
+        return self.institution
 
     def _determine_payment_type(self, payment_type_str: str):
         if not payment_type_str:
             return self.payment_type
         normalized = (payment_type_str or "").lower()
         if "ch" in normalized:
-            return PaymentType.objects.get_or_create(name="Cheque")[0]
+            return self.payment_types["Cheque"]
         if any(keyword in normalized for keyword in ["transf", "cta", "cuenta", "red"]):
-            return PaymentType.objects.get_or_create(name="Transferencia bancaria")[0]
-        self.payment_type, _ = PaymentType.objects.get_or_create(name="Otro")
+            return self.payment_types["Transferencia bancaria"]
+        self.payment_type = self.payment_types["Otro"]
         return self.payment_type
 
     def _get_disbursement_date(self, row):
-        value = row[14].value
+        value = row[14]
         if not isinstance(value, datetime):
             return None
-        disbursement_date = value.date() if row[14].value else None
+        disbursement_date = value.date() if row[14] else None
         # return previous value when no date is found
         if not disbursement_date:
             return self.disbursement_date
@@ -118,24 +276,22 @@ class ExcelProcessor:
         return disbursement_date
 
     def _get_disbursement_data(self, row) -> dict | None:
-        funds_origin = row[11].value
-        origin_details = row[12].value
+        funds_origin = row[11]
+        origin_details = row[12]
         if funds_origin:
-            self.funds_origin, _ = DisbursementOrigin.objects.get_or_create(
-                code=funds_origin,
-            )
-        if origin_details:
-            self.origin_details, _ = OriginDetail.objects.get_or_create(
-                name=origin_details.strip()
+            self.funds_origin = self.disbursement_origins.get(
+                self._to_int(funds_origin), self.funds_origin
             )
+        if origin_details := self._to_text(origin_details):
+            self.origin_details = self.origin_detail_names[origin_details]
         data = {
-            "resolution_amount": row[9].value,
-            "amount_disbursed": row[15].value,
-            "principal_name": row[6].value or "",
-            "principal_issued_id": row[7].value or "",
+            "resolution_amount": row[9],
+            "amount_disbursed": row[15],
+            "principal_name": row[6] or "",
+            "principal_issued_id": row[7] or "",
             "funds_origin": self.funds_origin,
             "origin_details": self.origin_details,
-            "payment_type": self._determine_payment_type(row[13].value),
+            "payment_type": self._determine_payment_type(row[13]),
         }
         return data
 
@@ -143,8 +299,8 @@ class ExcelProcessor:
         institution = self.get_institution(row)
         if not institution:
             return None
-        resolution_no = row[8].value
-        resolution_year = row[10].value
+        resolution_no = row[8]
+        resolution_year = row[10]
         if (
             self.resolution
             and self.resolution.document_number == resolution_no
@@ -176,12 +332,12 @@ class ExcelProcessor:
 
     @staticmethod
     def _get_balance_and_status(row) -> tuple[int, str]:
-        disbursed_amount = row[15].value
-        reported_amount = row[17].value
+        disbursed_amount = row[15]
+        reported_amount = row[17]
         if disbursed_amount and reported_amount:
             balance = disbursed_amount - reported_amount
         else:
-            balance = row[18].value
+            balance = row[18]
         return balance, (
             Report.ReportStatus.finished.value
             if balance <= 0
@@ -192,14 +348,12 @@ class ExcelProcessor:
         disbursement = self.get_or_create_disbursement(row)
         if not disbursement:
             return self.report
-        report_date = (
-            row[16].value.date() if isinstance(row[16].value, datetime) else None
-        )
+        report_date = row[16].date() if isinstance(row[16], datetime) else None
         if not report_date:
             return self.report
-        delivered_via = (row[20].value or "").strip()
-        comments = (row[21].value or "").strip()
-        # reported_amount = row[17].value
+        delivered_via = (row[20] or "").strip()
+        comments = (row[21] or "").strip()
+        # reported_amount = row[17]
         _, status = self._get_balance_and_status(row)
         self.report, _ = Report.objects.get_or_create(
             disbursement=disbursement,
@@ -212,62 +366,116 @@ class ExcelProcessor:
         )
         return self.report
 
-    @staticmethod
-    def _get_receipt_type(row) -> ReceiptType | None:
-        receipt_type_str = row[22].value.strip().title() if row[22].value else None
+    @classmethod
+    def _receipt_type_name(cls, row) -> str | None:
+        return cls._to_text(row[22]).title() or None
+
+    def _get_receipt_type(self, row) -> ReceiptType | None:
+        receipt_type_str = self._receipt_type_name(row)
         if not receipt_type_str:
             return None
-        receipt_type, _ = ReceiptType.objects.get_or_create(
-            name=receipt_type_str,
-        )
-        return receipt_type
+        return self.receipt_types[receipt_type_str]
 
-    @staticmethod
-    def _get_object_of_expenditure(row) -> AccountObject | None:
-        obj_no = row[24].value
-        try:
-            obj_no = int(obj_no)
-        except ValueError:
-            return None
-        try:
-            return AccountObject.objects.get(key=obj_no)
-        except AccountObject.DoesNotExist:
-            return None
+    def _get_object_of_expenditure(self, row) -> AccountObject | None:
+        account_object = self.account_objects.get(self._to_int(row[24]))
+        self.stats.cache("account_objects", account_object is not None)
+        return account_object
 
     @staticmethod
     def _parse_unit_price(unit_price_str):
         digits = "".join(num for num in re.findall(r"\d+", unit_price_str))
         return int(digits) if digits else 0
 
-    def process_receipt(self, row):
-        report = self.get_or_create_report(row)
-        receipt_number = (str(row[23].value) or "").strip()
+    def process_receipt(self, row, report: Report | None = None):
+        """
+        Queues the receipt item described by the row. Items are written in
+        batches by ``flush_receipts``.
+        """
+        report = report or self.get_or_create_report(row)
+        if not report:
+            return
+        receipt_number = str(row[23] or "").strip()
         if receipt_number.lower() == "rendido sin movimiento":
             return
         receipt_type = self._get_receipt_type(row)
         if not receipt_type:
             return
-        receipt_number = (str(row[23].value) or "").strip()
         object_of_expenditure = self._get_object_of_expenditure(row)
-        description = (row[25].value or "").strip()
-        receipt_date = (
-            row[26].value.date() if isinstance(row[26].value, datetime) else None
-        )
-        unit_price = row[27].value
+        description = (row[25] or "").strip()
+        receipt_date = row[26].date() if isinstance(row[26], datetime) else None
+        unit_price = row[27]
         if not unit_price:
             return
         if isinstance(unit_price, str):
             unit_price = self._parse_unit_price(unit_price)
-        receipt, _ = Receipt.objects.get_or_create(
-            report=report,
-            receipt_number=receipt_number,
-            receipt_date=receipt_date,
-            receipt_type=receipt_type,
+        self.pending_items.append(
+            (
+                report,
+                (report.id, receipt_number, receipt_date, receipt_type.id),
+                ReceiptItem(
+                    object_of_expenditure=object_of_expenditure,
+                    description=description or "No disponible",
+                    unit_price=unit_price,
+                    quantity=1,
+                ),
+            )
         )
-        ReceiptItem.objects.create(
-            receipt=receipt,
-            object_of_expenditure=object_of_expenditure,
-            description=description or "No disponible",
-            unit_price=unit_price,
-            quantity=1,
+
+    def flush_receipts(self):
+        """
+        Writes the queued items grouped by report: receipts that do not exist
+        yet and all the items are bulk created, which does not send the
+        per-receipt post_save signal, so the status of each affected report is
+        recomputed once afterwards.
+        """
+        if not self.pending_items:
+            return
+        with self.stats.stage("write_receipts"):
+            self._write_receipts()
+        self.pending_items = []
+
+    def _write_receipts(self):
+        reports = {report.id: report for report, _, _ in self.pending_items}
+        receipts = {
+            (
+                receipt.report_id,
+                receipt.receipt_number,
+                receipt.receipt_date,
+                receipt.receipt_type_id,
+            ): receipt
+            for receipt in Receipt.objects.without_totals().filter(
+                report_id__in=reports
+            )
+        }
+        new_receipts = {}
+        for report, key, _ in self.pending_items:
+            if key not in receipts and key not in new_receipts:
+                _, receipt_number, receipt_date, receipt_type_id = key
+                new_receipts[key] = Receipt(
+                    report=report,
+                    receipt_number=receipt_number,
+                    receipt_date=receipt_date,
+                    receipt_type_id=receipt_type_id,
+                    institution_id=report.institution_id,
+                    disbursement_id=report.disbursement_id,
+                )
+        with transaction.atomic():
+            Receipt.objects.bulk_create(new_receipts.values())
+            receipts.update(new_receipts)
+            items = []
+            for _, key, item in self.pending_items:
+                item.receipt = receipts[key]
+                items.append(item)
+            ReceiptItem.objects.bulk_create(items)
+            # existing receipts that got new items must reappear in the change feed
+            touch_receipts(
+                {item.receipt_id for item in items}
+                - {receipt.id for receipt in new_receipts.values()}
+            )
+            update_reports_status(reports.keys())
+            # bulk inserts do not send the signals that invalidate cached aggregates
+            invalidate(Receipt, ReceiptItem)
+        logger.info(
+            f"Created {len(new_receipts)} receipts and {len(items)} items "
+            f"for {len(reports)} reports"
         )
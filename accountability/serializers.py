@@ -1,7 +1,5 @@
 from django.db.models import (
     Sum,
-    ExpressionWrapper,
-    F,
     IntegerField,
 )
 from rest_framework import serializers
@@ -85,9 +83,12 @@ class DisbursementSerializer(serializers.ModelSerializer):
     def get_report(self, obj):
         if self.context.get("disbursement"):
             try:
-                return DisbursementReportSerializer(instance=obj.report).data
+                report = obj.report
             except Report.DoesNotExist:
                 return None
+            if hasattr(obj, "reported_amount"):
+                report.reported_amount = obj.reported_amount
+            return DisbursementReportSerializer(instance=report).data
 
 
 class DisbursementReportSerializer(serializers.ModelSerializer):
@@ -109,6 +110,9 @@ class DisbursementReportSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_reported_amount(obj):
+        # annotated by the viewsets' querysets
+        if hasattr(obj, "reported_amount"):
+            return obj.reported_amount
         return obj.receipts.aggregate(
             total=Sum("receipt_total", output_field=IntegerField())
         )["total"]
@@ -141,6 +145,8 @@ class AccountObjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = AccountObject
         fields = ("key", "value", "parent")
+        # read by get_parent, for the three levels of the tree
+        select_related = ("parent__parent",)
 
     def get_parent(self, obj):
         if obj.parent:
@@ -194,52 +200,79 @@ class ReceiptSerializer(serializers.ModelSerializer):
         return obj.receipt_total
 
 
-class AccountObjectChartSerializer(serializers.ModelSerializer):
+class AccountObjectChartSerializer(serializers.Serializer):
+    """
+    Serializes the expenditure tree nodes built by AccountObjectChartViewSet:
+    dictionaries with the object's fields, its children with expenditures and,
+    for leaves, their total expenditure
+    """
+
+    key = serializers.IntegerField()
+    value = serializers.CharField()
     children = serializers.SerializerMethodField()
-    total_expenditure = serializers.SerializerMethodField()
+    total_expenditure = serializers.ReadOnlyField()
+    comments = serializers.CharField()
+
+    def get_children(self, node):
+        if node["children"] is None:
+            return None
+        return AccountObjectChartSerializer(node["children"], many=True).data
+
 
+class DisbursementChangeSerializer(serializers.ModelSerializer):
     class Meta:
-        model = AccountObject
-        fields = ["key", "value", "children", "total_expenditure", "comments"]
+        model = Disbursement
+        fields = (
+            "id",
+            "resolution",
+            "institution",
+            "disbursement_date",
+            "resolution_amount",
+            "amount_disbursed",
+            "funds_origin",
+            "origin_details",
+            "due_date",
+            "principal_name",
+            "principal_issued_id",
+            "payment_type",
+            "comments",
+            "is_historical",
+            "created_at",
+            "updated_at",
+        )
 
-    def get_children(self, obj):
-        year = self.context.get("year")
-        if not obj.children.exists():
-            return None
-        if not obj.parent:
-            qs = obj.children.filter(
-                children__receipt_items__receipt__institution=self.context[
-                    "institution"
-                ]
-            )
-            if year:
-                qs = qs.filter(
-                    children__receipt_items__receipt__receipt_date__year=year
-                )
-        else:
-            qs = obj.children.filter(
-                receipt_items__receipt__institution=self.context["institution"]
-            )
-            if year:
-                qs = qs.filter(receipt_items__receipt__receipt_date__year=year)
-        return AccountObjectChartSerializer(
-            instance=qs.distinct(), many=True, context=self.context
-        ).data
-
-    def get_total_expenditure(self, obj):
-        if not obj.children.exists():
-            qs = ReceiptItem.objects.filter(
-                object_of_expenditure=obj,
-                receipt__institution=self.context["institution"],
-            ).distinct()
-            if self.context.get("year"):
-                qs = qs.filter(receipt__receipt_date__year=self.context.get("year"))
-            qs = qs.annotate(
-                subtotal=ExpressionWrapper(
-                    F("unit_price") * F("quantity"),
-                    output_field=IntegerField(),
-                )
-            )
-            total = qs.aggregate(total=Sum("subtotal"))["total"]
-            return total
-        return None
+
+class ReportChangeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Report
+        fields = (
+            "id",
+            "disbursement",
+            "institution",
+            "status",
+            "report_date",
+            "delivered_via",
+            "comments",
+            "created_at",
+            "updated_at",
+        )
+
+
+class ReceiptChangeSerializer(serializers.ModelSerializer):
+    receipt_total = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = Receipt
+        fields = (
+            "id",
+            "report",
+            "institution",
+            "disbursement",
+            "receipt_type",
+            "receipt_number",
+            "receipt_date",
+            "provider",
+            "receipt_total",
+            "created_at",
+            "updated_at",
+        )
@@ -1,3 +1,376 @@
+import io
+from datetime import datetime, timedelta
+from unittest import mock
+from urllib.parse import urlsplit
+
 from django.test import TestCase
+from django.utils import timezone
+from openpyxl import Workbook
+
+from accountability.models import (
+    AccountObject,
+    OriginDetail,
+    Receipt,
+    ReceiptItem,
+    ReceiptType,
+    Tombstone,
+)
+from accountability.processors import ExcelProcessor
+from core.cache import cache
+from core.testing import QueryCountTestCase, create_institution_data
+
+
+class DisbursementSummaryTestCase(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = [create_institution_data(index) for index in range(1, 4)]
+
+    def summary(self, params=None):
+        return self.fetch_json("/api/disbursements/", params)[0]["summary"]
+
+    def test_summary_totals(self):
+        self.assertEqual(
+            self.summary(), {"totalDisbursed": 3000, "totalReported": 2400.0}
+        )
+        self.assertEqual(
+            self.summary({"institution": self.data[1]["institution"].pk}),
+            {"totalDisbursed": 1000, "totalReported": 800.0},
+        )
+
+    def test_summary_is_invalidated_by_new_items(self):
+        self.summary()
+        with self.captureOnCommitCallbacks(execute=True):
+            ReceiptItem.objects.create(
+                receipt=self.data[0]["receipt"],
+                unit_price=100,
+                quantity=1,
+                description="extra",
+            )
+        self.assertEqual(
+            self.summary(), {"totalDisbursed": 3000, "totalReported": 2500.0}
+        )
+
+
+class DisbursementListQueryCountTestCase(QueryCountTestCase):
+    def list_disbursements(self):
+        data, query_count = self.fetch_json("/api/disbursements/")
+        return data["results"], query_count
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        create_institution_data(1)
+        _, single_row_count = self.list_disbursements()
+        for index in range(2, 6):
+            create_institution_data(index)
+        # recompute the summary, as for the first page
+        cache.clear()
+        results, query_count = self.list_disbursements()
+        self.assertEqual(query_count, single_row_count)
+        self.assertEqual(
+            sorted(result["institutionName"] for result in results),
+            [f"Escuela {index}" for index in range(1, 6)],
+        )
+        for result in results:
+            self.assertEqual(result["resolution"]["documentYear"], 2023)
+            self.assertEqual(result["report"]["reportedAmount"], 800)
+            self.assertEqual(result["report"]["balance"], 200)
+
+
+class ReceiptListQueryCountTestCase(QueryCountTestCase):
+    def list_receipts(self):
+        data, query_count = self.fetch_json("/api/receipts/", {"limit": 100})
+        return data["results"], query_count
+
+    def create_receipts(self, indexes):
+        for index in indexes:
+            create_institution_data(index)
+        # items point to third level objects, whose parents are also serialized
+        group, _ = AccountObject.objects.get_or_create(key=10000, value="Grupo")
+        subgroup, _ = AccountObject.objects.get_or_create(
+            key=10100, value="Subgrupo", parent=group
+        )
+        AccountObject.objects.filter(key__lt=10000).update(parent=subgroup)
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        self.create_receipts(range(1, 2))
+        _, single_row_count = self.list_receipts()
+        self.create_receipts(range(2, 101))
+        results, query_count = self.list_receipts()
+        self.assertEqual(len(results), 100)
+        self.assertEqual(query_count, single_row_count)
+        for receipt in results:
+            index = int(receipt["receiptNumber"].removeprefix("001-"))
+            self.assertEqual(receipt["receiptTotal"], 800.0)
+            self.assertEqual(receipt["provider"]["name"], f"Proveedor {index}")
+            self.assertEqual(
+                receipt["institution"]["establishment"]["locality"]["district"][
+                    "department"
+                ]["name"],
+                f"Depto {index}",
+            )
+            (item,) = receipt["items"]
+            self.assertEqual(item["objectOfExpenditure"]["key"], index)
+            self.assertEqual(
+                item["objectOfExpenditure"]["parent"]["parent"]["key"], 10000
+            )
+
+
+class AccountObjectChartTestCase(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = [create_institution_data(index) for index in range(1, 4)]
+        group = AccountObject.objects.create(key=100, value="Grupo")
+        subgroup = AccountObject.objects.create(key=140, value="Subgrupo", parent=group)
+        AccountObject.objects.create(key=200, value="Sin gastos")
+        AccountObject.objects.filter(key__lt=100).update(parent=subgroup)
+
+    def chart(self, index, **params):
+        institution = self.data[index - 1]["institution"]
+        data, query_count = self.fetch_json(
+            "/api/account-objects/", {"institution": institution.pk, **params}
+        )
+        return data["results"], query_count
+
+    def expected_chart(self, index):
+        leaf = {
+            "key": index,
+            "value": f"Objeto {index}",
+            "children": None,
+            "totalExpenditure": 800,
+            "comments": "",
+        }
+        subgroup = {
+            "key": 140,
+            "value": "Subgrupo",
+            "children": [leaf],
+            "totalExpenditure": None,
+            "comments": "",
+        }
+        return [
+            {
+                "key": 100,
+                "value": "Grupo",
+                "children": [subgroup],
+                "totalExpenditure": None,
+                "comments": "",
+            }
+        ]
+
+    def test_tree_with_leaf_totals(self):
+        self.assertEqual(self.chart(2)[0], self.expected_chart(2))
+        self.assertEqual(self.chart(2, year=2023)[0], self.expected_chart(2))
+        self.assertEqual(self.chart(2, year=2022)[0], [])
+
+    def test_single_grouped_query(self):
+        self.chart(1)
+        results, query_count = self.chart(2)
+        self.assertEqual(results, self.expected_chart(2))
+        # the tree is cached, so only the grouped item totals are queried
+        self.assertEqual(query_count, 1)
+
+    def test_totals_of_several_leaves(self):
+        receipt = self.data[1]["receipt"]
+        leaf = self.data[0]["item"].object_of_expenditure
+        ReceiptItem.objects.create(
+            receipt=receipt, object_of_expenditure=leaf, unit_price=50, quantity=3
+        )
+        (group,) = self.chart(2)[0]
+        (subgroup,) = group["children"]
+        self.assertEqual(
+            [(node["key"], node["totalExpenditure"]) for node in subgroup["children"]],
+            [(1, 150), (2, 800)],
+        )
+        self.assertIsNone(subgroup["totalExpenditure"])
+        self.assertIsNone(group["totalExpenditure"])
+
+    def test_retrieve_nested_nodes(self):
+        leaf = AccountObject.objects.get(key=2)
+        subgroup = leaf.parent
+        for account_object, expected in (
+            (subgroup.parent, self.expected_chart(2)[0]),
+            (subgroup, self.expected_chart(2)[0]["children"][0]),
+            (leaf, self.expected_chart(2)[0]["children"][0]["children"][0]),
+        ):
+            with self.subTest(key=account_object.key):
+                data, _ = self.fetch_json(
+                    f"/api/account-objects/{account_object.pk}/",
+                    {"institution": self.data[1]["institution"].pk},
+                )
+                self.assertEqual(data, expected)
+        response = self.client.get(
+            f"/api/account-objects/{self.data[0]['item'].object_of_expenditure_id}/",
+            {"institution": self.data[1]["institution"].pk},
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class ExcelProcessorTestCase(TestCase):
+    def workbook(self, rows) -> io.BytesIO:
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.title = "General"
+        for _ in range(ExcelProcessor.FIRST_ROW - 1):
+            sheet.append(["encabezado"])
+        for row in rows:
+            sheet.append(row)
+        file = io.BytesIO()
+        workbook.save(file)
+        file.seek(0)
+        return file
+
+    @staticmethod
+    def row(receipt_type, origin_detail="Gratuidad", unit_price=1000):
+        row = [None] * ExcelProcessor.COLUMNS
+        row[0], row[1], row[3] = "E1", "1", "Escuela 1"
+        row[8], row[9], row[10] = 55, 5000, 2023
+        row[11], row[12], row[13] = 10, origin_detail, "Transferencia"
+        row[14], row[15] = datetime(2023, 3, 1), 5000
+        row[16], row[17], row[18] = datetime(2023, 6, 1), 5000, 0
+        row[20], row[22], row[23] = "RUE", receipt_type, "001-1"
+        row[25], row[26], row[27] = "Útiles", datetime(2023, 5, 1), unit_price
+        return row
+
+    def process(self, rows):
+        processor = ExcelProcessor(self.workbook(rows))
+        try:
+            skipped_rows = processor.process()
+        finally:
+            processor.close()
+        return processor, skipped_rows
+
+    def test_non_text_cells_do_not_abort_the_import(self):
+        create_institution_data(1)
+        processor, skipped_rows = self.process(
+            [
+                self.row("factura"),
+                self.row(5, origin_detail=123, unit_price=500),
+                self.row(datetime(2023, 1, 1)),
+                [None] * ExcelProcessor.COLUMNS,
+                [None] * ExcelProcessor.COLUMNS,
+                self.row("basura", origin_detail="Basura"),
+            ]
+        )
+        self.assertEqual(processor.rows_processed, 3)
+        self.assertEqual(skipped_rows, [])
+        self.assertEqual(
+            sorted(
+                ReceiptItem.objects.filter(receipt__receipt_number="001-1")
+                .exclude(receipt__receipt_type__name="Factura 1")
+                .values_list("receipt__receipt_type__name", "unit_price")
+            ),
+            [("5", 500), ("Factura", 1000)],
+        )
+        # rows after the two empty rows that end the data are not read
+        self.assertFalse(ReceiptType.objects.filter(name="Basura").exists())
+        self.assertFalse(OriginDetail.objects.filter(name="Basura").exists())
+        self.assertTrue(OriginDetail.objects.filter(name="123").exists())
+
+    def test_new_items_touch_existing_receipts(self):
+        create_institution_data(1)
+        self.process([self.row("factura")])
+        receipt = Receipt.objects.without_totals().get(receipt_type__name="Factura")
+        earlier = timezone.now() - timedelta(hours=1)
+        Receipt.objects.without_totals().update(updated_at=earlier)
+        self.process([self.row("factura", unit_price=700)])
+        receipt.refresh_from_db()
+        self.assertGreater(receipt.updated_at, earlier)
+        self.assertEqual(receipt.items.count(), 2)
+
+    def test_sheet_is_read_once_in_batches(self):
+        create_institution_data(1)
+        rows = [self.row("factura", unit_price=100 + index) for index in range(4)]
+        rows.append(self.row("recibo", origin_detail="Canasta", unit_price=900))
+        iter_rows = ExcelProcessor.iter_rows
+        with mock.patch.object(
+            ExcelProcessor, "RECEIPT_BATCH_SIZE", 2
+        ), mock.patch.object(
+            ExcelProcessor, "iter_rows", autospec=True, side_effect=iter_rows
+        ) as read:
+            processor, skipped_rows = self.process(rows)
+        read.assert_called_once()
+        self.assertEqual(skipped_rows, [])
+        self.assertEqual(processor.rows_processed, 5)
+        self.assertEqual(processor.stats.stages["write_receipts"]["calls"], 3)
+        # references first used by the last batch are created for it
+        self.assertEqual(
+            sorted(
+                ReceiptItem.objects.filter(receipt__receipt_number="001-1")
+                .exclude(receipt__receipt_type__name="Factura 1")
+                .values_list("receipt__receipt_type__name", "unit_price")
+            ),
+            [
+                ("Factura", 100),
+                ("Factura", 101),
+                ("Factura", 102),
+                ("Factura", 103),
+                ("Recibo", 900),
+            ],
+        )
+        self.assertTrue(OriginDetail.objects.filter(name="Canasta").exists())
+
+
+class ChangeFeedTestCase(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.receipts = [
+            create_institution_data(index)["receipt"] for index in range(1, 4)
+        ]
+        self.start = timezone.now() - timedelta(hours=1)
+        Receipt.objects.without_totals().update(updated_at=self.start)
+
+    def changes(self, **params):
+        data, _ = self.fetch_json(
+            "/api/changes/", {"collection": "receipts", "since": self.start, **params}
+        )
+        return data
+
+    @staticmethod
+    def entries(data):
+        return [(entry["id"], entry["deleted"]) for entry in data["results"]]
+
+    def test_pages_follow_the_keyset(self):
+        ids = [receipt.pk for receipt in self.receipts]
+        data = self.changes(limit=2)
+        self.assertEqual(self.entries(data), [(ids[0], False), (ids[1], False)])
+        # receipts sharing a timestamp continue after the last id of the page
+        url = urlsplit(data["next"])
+        next_page, _ = self.fetch_json(f"{url.path}?{url.query}")
+        self.assertEqual(self.entries(next_page), [(ids[2], False)])
+        self.assertIsNone(next_page["next"])
+
+    def test_since_boundary(self):
+        later = self.start + timedelta(minutes=1)
+        Receipt.objects.without_totals().filter(pk=self.receipts[2].pk).update(
+            updated_at=later
+        )
+        self.assertEqual(
+            self.entries(self.changes(since=later)), [(self.receipts[2].pk, False)]
+        )
+        self.assertEqual(
+            self.entries(self.changes(since=later + timedelta(microseconds=1))), []
+        )
+
+    def test_tombstones_are_merged_in_order(self):
+        first, deleted, last = [receipt.pk for receipt in self.receipts]
+        self.receipts[1].delete()
+        Tombstone.objects.update(deleted_at=self.start + timedelta(minutes=1))
+        Receipt.objects.without_totals().filter(pk=last).update(
+            updated_at=self.start + timedelta(minutes=2)
+        )
+        data = self.changes()
+        self.assertEqual(
+            self.entries(data), [(first, False), (deleted, True), (last, False)]
+        )
+        self.assertIsNone(data["results"][1]["data"])
 
-# Create your tests here.
+    def test_item_changes_touch_their_receipt(self):
+        since = self.start + timedelta(minutes=1)
+        receipt = self.receipts[1]
+        item = ReceiptItem.objects.create(
+            receipt=receipt, unit_price=100, quantity=1, description="extra"
+        )
+        data = self.changes(since=since)
+        self.assertEqual(self.entries(data), [(receipt.pk, False)])
+        self.assertEqual(data["results"][0]["data"]["receiptTotal"], 900.0)
+        Receipt.objects.without_totals().update(updated_at=self.start)
+        item.delete()
+        self.assertEqual(self.entries(self.changes(since=since)), [(receipt.pk, False)])
@@ -1,3 +1,4 @@
+from django.urls import path
 from rest_framework import routers
 
 from accountability.views import (
@@ -7,6 +8,7 @@ from accountability.views import (
     AccountObjectChartViewSet,
     ReceiptItemViewSet,
     ResolutionViewSet,
+    ChangeFeedView,
 )
 
 router = routers.SimpleRouter()
@@ -18,4 +20,6 @@ router.register("receipts", ReceiptViewSet)
 router.register("account-objects", AccountObjectChartViewSet)
 router.register("receipt-items", ReceiptItemViewSet)
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    path("changes/", ChangeFeedView.as_view(), name="changes"),
+]
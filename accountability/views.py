@@ -1,9 +1,20 @@
-from django.db.models import Sum, ExpressionWrapper, F, Value
-from django.db.models.functions import Coalesce
+import heapq
+from collections import defaultdict
+from itertools import islice
+
+from django.db.models import Sum, ExpressionWrapper, F, Value, Q
+from django.db.models import FloatField, OuterRef, Subquery
+from django.db.models.functions import Cast, Coalesce
 from django.db.models import IntegerField
+from django.http import Http404, QueryDict
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from rest_framework import viewsets
+from rest_framework import serializers, viewsets
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.views import APIView
 
 from accountability.filters import (
     DisbursementFilter,
@@ -18,6 +29,8 @@ from accountability.models import (
     ReceiptItem,
     AccountObject,
     Resolution,
+    Tombstone,
+    report_total_subquery,
 )
 from accountability.serializers import (
     ReportSerializer,
@@ -26,8 +39,12 @@ from accountability.serializers import (
     AccountObjectChartSerializer,
     ReceiptItemSerializer,
     ResolutionSerializer,
+    DisbursementChangeSerializer,
+    ReportChangeSerializer,
+    ReceiptChangeSerializer,
 )
-from core.models import Institution
+from core.cache import cached_aggregate
+from core.eager_loading import EagerLoadingMixin
 
 
 class ResolutionViewSet(viewsets.ReadOnlyModelViewSet):
@@ -37,8 +54,17 @@ class ResolutionViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 class DisbursementViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Disbursement.objects.all().order_by(
-        "-resolution__document_year", "-disbursement_date"
+    queryset = (
+        Disbursement.objects.select_related(
+            "report",
+            "resolution",
+            "institution",
+            "funds_origin",
+            "origin_details",
+            "payment_type",
+        )
+        .annotate(reported_amount=Cast(report_total_subquery("report"), IntegerField()))
+        .order_by("-resolution__document_year", "-disbursement_date")
     )
     serializer_class = DisbursementSerializer
     filterset_class = DisbursementFilter
@@ -49,31 +75,55 @@ class DisbursementViewSet(viewsets.ReadOnlyModelViewSet):
         return context
 
     def list(self, request, *args, **kwargs):
-        qs = self.filter_queryset(self.get_queryset())
-        total_disbursed = qs.distinct().aggregate(total=Sum("amount_disbursed"))[
-            "total"
-        ]
-        reports = Report.objects.filter(disbursement__in=qs).distinct()
-        receipts = Receipt.objects.filter(report__in=reports).distinct()
-        total_reported = receipts.aggregate(reported=Sum("receipt_total"))["reported"]
-        response_data = super().list(request, *args, **kwargs).data
-        response_data["summary"] = {
-            "total_disbursed": total_disbursed,
-            "total_reported": total_reported,
-        }
-        return Response(data=response_data)
-
-
-class ReportViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Report.objects.all().order_by(
+        response = super().list(request, *args, **kwargs)
+        response.data = {**response.data, "summary": self.get_totals()}
+        return response
+
+    def get_totals(self):
+        return cached_aggregate(
+            "disbursement-summary",
+            [Disbursement, Resolution, Receipt, ReceiptItem],
+            self.request.query_params,
+            self.compute_totals,
+        )
+
+    def compute_totals(self):
+        """
+        Sums the disbursed and reported amounts of the filtered disbursements
+        in a single query, reading the items of each disbursement through the
+        receipts' ``disbursement`` key instead of going through the reports
+        """
+        ids = self.filter_queryset(self.get_queryset()).values("pk")
+        reported = (
+            ReceiptItem.objects.filter(receipt__disbursement=OuterRef("pk"))
+            .values("receipt__disbursement")
+            .annotate(
+                total=Sum(F("unit_price") * F("quantity"), output_field=FloatField())
+            )
+            .values("total")
+        )
+        return (
+            Disbursement.objects.filter(pk__in=ids)
+            .annotate(reported=Subquery(reported))
+            .aggregate(
+                total_disbursed=Sum("amount_disbursed"),
+                total_reported=Sum("reported"),
+            )
+        )
+
+
+class ReportViewSet(EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Report.objects.annotate(
+        reported_amount=Cast(report_total_subquery(), IntegerField())
+    ).order_by(
         "-disbursement__resolution__document_year", "-disbursement__disbursement_date"
     )
     serializer_class = ReportSerializer
     filterset_class = ReportFilter
 
 
-class ReceiptViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Receipt.objects.all()
+class ReceiptViewSet(EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Receipt.objects.with_total_subquery().order_by("-receipt_date", "id")
     serializer_class = ReceiptSerializer
     filterset_class = ReceiptFilter
 
@@ -85,25 +135,21 @@ class ReceiptItemViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 class AccountObjectChartViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Expenditure tree of an institution, optionally for a single year. Item
+    totals are computed with one grouped query and placed on a cached copy of
+    the account object tree; only branches with expenditures are returned,
+    with totals on their leaves.
+    """
+
     queryset = AccountObject.objects.all()
     serializer_class = AccountObjectChartSerializer
 
-    def _get_institution(self):
-        institution_id = self.request.GET.get("institution")
+    def _get_institution_id(self):
         try:
-            institution_id = int(institution_id)
+            return int(self.request.GET.get("institution"))
         except (ValueError, TypeError):
             return None
-        try:
-            return Institution.objects.get(pk=institution_id)
-        except Institution.DoesNotExist:
-            return None
-
-    def get_serializer_context(self):
-        context = super().get_serializer_context()
-        context["year"] = self._get_year()
-        context["institution"] = self._get_institution()
-        return context
 
     def _get_year(self):
         year = self.request.GET.get("year", None)
@@ -112,20 +158,198 @@ class AccountObjectChartViewSet(viewsets.ReadOnlyModelViewSet):
         except (ValueError, TypeError):
             return None
 
-    def get_queryset(self):
-        institution = self._get_institution()
-        year = self._get_year()
-        if not institution or ("year" in self.request.GET.keys() and not year):
-            return AccountObject.objects.none()
-        leaf_qs = AccountObject.objects.filter(
-            receipt_items__receipt__institution=institution
+    @staticmethod
+    def get_tree():
+        """Account objects as ``(id, key, value, comments, parent_id)``"""
+        return cached_aggregate(
+            "account-object-tree",
+            [AccountObject],
+            QueryDict(),
+            lambda: list(
+                AccountObject.objects.order_by("pk").values_list(
+                    "id", "key", "value", "comments", "parent_id"
+                )
+            ),
         )
+
+    def get_totals(self, institution_id, year):
+        """Total expenditure of the institution per account object"""
+        items = ReceiptItem.objects.filter(receipt__institution=institution_id)
         if year:
-            leaf_qs = leaf_qs.filter(receipt_items__receipt__receipt_date__year=year)
-        second_level_qs = AccountObject.objects.filter(
-            children__in=leaf_qs.distinct()
-        ).distinct()
-        top_level_qs = AccountObject.objects.filter(
-            children__in=second_level_qs
-        ).distinct()
-        return top_level_qs
+            items = items.filter(receipt__receipt_date__year=year)
+        return dict(
+            items.values("object_of_expenditure")
+            .annotate(
+                total=Sum(
+                    ExpressionWrapper(
+                        F("unit_price") * F("quantity"), output_field=IntegerField()
+                    )
+                )
+            )
+            .values_list("object_of_expenditure", "total")
+        )
+
+    @staticmethod
+    def build_nodes(tree, totals):
+        """
+        Returns the root nodes that have expenditures and, within them, only
+        the branches that have any. Totals are set on the leaves; the charts
+        add them up themselves.
+        """
+        children = defaultdict(list)
+        for account_object in tree:
+            children[account_object[4]].append(account_object)
+
+        def build(account_object):
+            pk, key, value, comments, _ = account_object
+            node = {"id": pk, "key": key, "value": value, "comments": comments}
+            if pk not in children:
+                if pk not in totals:
+                    return None
+                return {**node, "children": None, "total_expenditure": totals[pk]}
+            nodes = [child for child in map(build, children[pk]) if child]
+            if not nodes:
+                return None
+            return {**node, "children": nodes, "total_expenditure": None}
+
+        return [node for node in map(build, children[None]) if node]
+
+    def get_nodes(self):
+        institution_id = self._get_institution_id()
+        year = self._get_year()
+        if not institution_id or ("year" in self.request.GET.keys() and not year):
+            return []
+        return self.build_nodes(self.get_tree(), self.get_totals(institution_id, year))
+
+    def list(self, request, *args, **kwargs):
+        nodes = self.get_nodes()
+        page = self.paginate_queryset(nodes)
+        if page is not None:
+            return self.get_paginated_response(
+                self.get_serializer(page, many=True).data
+            )
+        return Response(self.get_serializer(nodes, many=True).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        nodes = self.get_nodes()
+        while nodes:
+            for node in nodes:
+                if str(node["id"]) == str(kwargs[self.lookup_field]):
+                    return Response(self.get_serializer(node).data)
+            nodes = [child for node in nodes for child in node["children"] or []]
+        raise Http404
+
+
+class ChangeFeedView(APIView):
+    """
+    Rows of a collection created or updated since ``since`` and the ones
+    deleted since then, in ``updated_at, id`` keyset order. Each page links to
+    the next one through ``since`` and ``after``, the timestamp and id of its
+    last entry.
+    """
+
+    default_limit = 500
+    max_limit = 1000
+    feeds = {
+        Tombstone.Collection.disbursements: (
+            Disbursement.objects.all(),
+            DisbursementChangeSerializer,
+        ),
+        Tombstone.Collection.reports: (Report.objects.all(), ReportChangeSerializer),
+        Tombstone.Collection.receipts: (
+            Receipt.objects.with_total_subquery(),
+            ReceiptChangeSerializer,
+        ),
+    }
+
+    def _get_since(self):
+        since = self.request.query_params.get("since")
+        try:
+            since = parse_datetime(since or "")
+        except ValueError:
+            since = None
+        if not since:
+            raise ValidationError({"since": "Ingrese una fecha y hora ISO 8601."})
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    def _get_int_param(self, name, default=None):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError({name: "Ingrese un número entero."})
+
+    @staticmethod
+    def _keyset_filter(timestamp_field, id_field, since, after):
+        if after is None:
+            return Q(**{f"{timestamp_field}__gte": since})
+        return Q(**{f"{timestamp_field}__gt": since}) | Q(
+            **{timestamp_field: since, f"{id_field}__gt": after}
+        )
+
+    def get(self, request, *args, **kwargs):
+        collection = request.query_params.get("collection")
+        if collection not in self.feeds:
+            raise ValidationError(
+                {"collection": f"Opciones válidas: {', '.join(self.feeds)}."}
+            )
+        since = self._get_since()
+        after = self._get_int_param("after")
+        limit = min(
+            max(self._get_int_param("limit", self.default_limit), 1), self.max_limit
+        )
+        queryset, serializer_class = self.feeds[collection]
+        rows = queryset.filter(
+            self._keyset_filter("updated_at", "id", since, after)
+        ).order_by("updated_at", "id")[:limit]
+        tombstones = (
+            Tombstone.objects.filter(collection=collection)
+            .filter(self._keyset_filter("deleted_at", "object_id", since, after))
+            .order_by("deleted_at", "object_id")[:limit]
+        )
+        entries = list(
+            islice(
+                heapq.merge(
+                    (
+                        (row.updated_at, row.id, False, serializer_class(row).data)
+                        for row in rows
+                    ),
+                    (
+                        (tombstone.deleted_at, tombstone.object_id, True, None)
+                        for tombstone in tombstones
+                    ),
+                    key=lambda entry: entry[:2],
+                ),
+                limit,
+            )
+        )
+        timestamp_field = serializers.DateTimeField()
+        next_url = None
+        if len(entries) == limit:
+            last_timestamp, last_id, _, _ = entries[-1]
+            next_url = replace_query_param(
+                replace_query_param(
+                    request.build_absolute_uri(), "since", last_timestamp.isoformat()
+                ),
+                "after",
+                last_id,
+            )
+        return Response(
+            {
+                "collection": collection,
+                "next": next_url,
+                "results": [
+                    {
+                        "id": object_id,
+                        "updated_at": timestamp_field.to_representation(timestamp),
+                        "deleted": deleted,
+                        "data": data,
+                    }
+                    for timestamp, object_id, deleted, data in entries
+                ],
+            }
+        )
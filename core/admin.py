@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.admin import register, display
+from django.utils.html import format_html, format_html_join
 from django.contrib.contenttypes.admin import GenericTabularInline
 from unfold.admin import ModelAdmin, TabularInline
 from unfold.contrib.forms.widgets import WysiwygWidget
@@ -12,6 +13,7 @@ from core.models import (
     Establishment,
     Document,
     Resource,
+    ImportJob,
 )
 
 
@@ -131,3 +133,92 @@ class ResourceAdmin(ModelAdmin):
             "widget": WysiwygWidget,
         }
     }
+
+
+@register(ImportJob)
+class ImportJobAdmin(ModelAdmin):
+    list_display = (
+        "__str__",
+        "status",
+        "rows_done",
+        "rows_skipped",
+        "get_rows_per_second",
+        "created_by",
+    )
+    list_filter = ("kind", "status")
+    change_form_template = "admin/core/importjob/change_form.html"
+
+    def get_fields(self, request, obj=None):
+        if not obj:
+            return ["kind", "file"]
+        return [
+            ("kind", "status"),
+            "file",
+            ("rows_done", "rows_skipped", "get_rows_per_second"),
+            ("started_at", "finished_at"),
+            "created_by",
+            "get_skipped_rows",
+            "stats",
+            "error",
+        ]
+
+    def get_readonly_fields(self, request, obj=None):
+        if not obj:
+            return []
+        return [
+            "kind",
+            "file",
+            "status",
+            "rows_done",
+            "rows_skipped",
+            "get_rows_per_second",
+            "started_at",
+            "finished_at",
+            "created_by",
+            "get_skipped_rows",
+            "stats",
+            "error",
+        ]
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.created_by = request.user
+        super().save_model(request, obj, form, change)
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_module_permission(self, request):
+        return request.user.is_superuser
+
+    def has_view_permission(self, request, obj=None):
+        return request.user.is_superuser
+
+    def has_add_permission(self, request):
+        return request.user.is_superuser
+
+    @display(description="Filas por segundo")
+    def get_rows_per_second(self, obj):
+        return obj.rows_per_second
+
+    @display(description="Filas omitidas")
+    def get_skipped_rows(self, obj):
+        if not obj.skipped_rows:
+            return "-"
+        return format_html(
+            "<ul>{}</ul>",
+            format_html_join(
+                "",
+                "<li>Fila {}: {}</li>",
+                ((line, reason) for line, reason in obj.skipped_rows),
+            ),
+        )
+
+    def change_view(self, request, object_id, form_url="", extra_context=None):
+        job = self.get_object(request, object_id)
+        extra_context = {
+            **(extra_context or {}),
+            "refresh": job
+            and job.status in (ImportJob.Status.pending, ImportJob.Status.running),
+        }
+        return super().change_view(request, object_id, form_url, extra_context)
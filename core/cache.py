@@ -0,0 +1,77 @@
+import hashlib
+import time
+from typing import Callable, Iterable
+
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.connection import ConnectionProxy
+
+cache = ConnectionProxy(caches, "aggregates")
+
+# seconds a cached aggregate is kept, bounding staleness after writes that do
+# not send signals, such as raw SQL
+AGGREGATE_TIMEOUT = 60 * 60
+# query parameters that do not change which rows are aggregated
+IGNORED_PARAMS = ("limit", "offset", "ordering", "format")
+
+
+def _generation_key(model) -> str:
+    return f"generation:{model._meta.label_lower}"
+
+
+def invalidate(*models):
+    """
+    Starts a new generation for the models once the current transaction
+    commits, so that every cached aggregate depending on them is computed
+    again. Generations are timestamps rather than counters so that an
+    evicted generation never reuses an old key.
+    """
+    transaction.on_commit(
+        lambda: cache.set_many(
+            {_generation_key(model): time.time_ns() for model in models},
+            timeout=None,
+        )
+    )
+
+
+def generations(models: Iterable) -> list:
+    keys = [_generation_key(model) for model in models]
+    values = cache.get_many(keys)
+    missing = [key for key in keys if key not in values]
+    if missing:
+        for key in missing:
+            cache.add(key, time.time_ns(), timeout=None)
+        values.update(cache.get_many(missing))
+    return [values.get(key) for key in keys]
+
+
+def params_signature(params) -> str:
+    """Digest of the filtering query parameters, independent of their order"""
+    items = sorted(
+        (key, sorted(value for value in params.getlist(key) if value))
+        for key in params
+        if key not in IGNORED_PARAMS
+    )
+    normalized = repr([(key, values) for key, values in items if values])
+    return hashlib.sha256(normalized.encode()).hexdigest()[:32]
+
+
+def cached_aggregate(
+    name: str,
+    models: Iterable,
+    params,
+    compute: Callable,
+    timeout: int = AGGREGATE_TIMEOUT,
+):
+    """
+    Returns the value computed by ``compute`` for the given query parameters,
+    cached until any of ``models`` changes.
+    """
+    models = list(models)
+    generation = hashlib.sha256(repr(generations(models)).encode()).hexdigest()[:16]
+    key = f"aggregate:{name}:{generation}:{params_signature(params)}"
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout)
+    return value
@@ -0,0 +1,91 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch, QuerySet
+from rest_framework import serializers
+
+
+def _relation(model, name: str):
+    """The model field named ``name`` when it is a relation, otherwise None"""
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    # foreign key columns such as ``institution_id`` need no join
+    return field if field.is_relation and field.name == name else None
+
+
+def _source_relations(model, source_attrs: list[str]):
+    """
+    Follows the single-valued relations of a dotted source, such as
+    ``institution.name``, returning their path and the model they lead to
+    """
+    path = []
+    for name in source_attrs:
+        field = _relation(model, name)
+        if not field or field.many_to_many or field.one_to_many:
+            break
+        path.append(name)
+        model = field.related_model
+    return path, model
+
+
+def eager_loading_plan(serializer, prefix: str = ""):
+    """
+    Walks the fields of a model serializer and returns the ``select_related``
+    paths and ``Prefetch`` objects needed to serialize a queryset without
+    further queries. Nested serializers of single-valued relations are
+    joined; nested lists of related objects are prefetched with their own
+    plan. Relations read by method fields are declared in the serializer's
+    ``Meta.select_related``.
+    """
+    model = serializer.Meta.model
+    select_related = [
+        prefix + path for path in getattr(serializer.Meta, "select_related", ())
+    ]
+    prefetch_related = []
+    for field in serializer.fields.values():
+        if field.source == "*" or not field.source_attrs:
+            continue
+        if isinstance(field, serializers.ListSerializer):
+            relation = _relation(model, field.source_attrs[0])
+            if relation and isinstance(field.child, serializers.ModelSerializer):
+                prefetch_related.append(
+                    Prefetch(
+                        prefix + relation.name,
+                        queryset=with_eager_loading(
+                            relation.related_model._default_manager.all(),
+                            field.child,
+                        ),
+                    )
+                )
+            continue
+        path, related_model = _source_relations(model, field.source_attrs)
+        if not path:
+            continue
+        lookup = prefix + "__".join(path)
+        if isinstance(field, serializers.ModelSerializer) and len(path) == len(
+            field.source_attrs
+        ):
+            nested_select, nested_prefetch = eager_loading_plan(
+                field, prefix=f"{lookup}__"
+            )
+            select_related.extend(nested_select or [lookup])
+            prefetch_related.extend(nested_prefetch)
+        else:
+            select_related.append(lookup)
+    return select_related, prefetch_related
+
+
+def with_eager_loading(queryset: QuerySet, serializer) -> QuerySet:
+    select_related, prefetch_related = eager_loading_plan(serializer)
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    return queryset
+
+
+class EagerLoadingMixin:
+    """Viewset mixin that eager loads what its serializer reads"""
+
+    def get_queryset(self):
+        return with_eager_loading(super().get_queryset(), self.get_serializer())
@@ -0,0 +1,114 @@
+import cProfile
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+from django.db import connections
+
+
+class ImportStats:
+    """
+    Collects wall-clock time, database queries and call counts per import
+    stage, plus hit rates of the importer caches.
+
+    Stages may be nested; the time and queries of an inner stage are also
+    included in the enclosing one.
+    """
+
+    def __init__(self, using: str = "default"):
+        self.using = using
+        self.queries = 0
+        self.stages = defaultdict(lambda: {"seconds": 0.0, "queries": 0, "calls": 0})
+        self.caches = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self.started = time.perf_counter()
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def track_queries(self):
+        """Counts every query executed on the connection while active"""
+        with connections[self.using].execute_wrapper(self._count_query):
+            yield self
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        queries = self.queries
+        try:
+            yield
+        finally:
+            stage = self.stages[name]
+            stage["seconds"] += time.perf_counter() - start
+            stage["queries"] += self.queries - queries
+            stage["calls"] += 1
+
+    def timed_iter(self, name: str, iterable: Iterable) -> Iterator:
+        """Yields from the iterable, timing only the production of each item"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def cache(self, name: str, hit: bool):
+        self.caches[name]["hits" if hit else "misses"] += 1
+
+    def merge(self, summary: dict):
+        """Adds the stages and caches of another run's summary"""
+        self.queries += summary["queries"]
+        for name, values in summary["stages"].items():
+            for key in ("seconds", "queries", "calls"):
+                self.stages[name][key] += values[key]
+        for name, values in summary["caches"].items():
+            self.caches[name]["hits"] += values["hits"]
+            self.caches[name]["misses"] += values["misses"]
+
+    def summary(self) -> dict:
+        return {
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "queries": self.queries,
+            "stages": {
+                name: {**values, "seconds": round(values["seconds"], 3)}
+                for name, values in self.stages.items()
+            },
+            "caches": {
+                name: {
+                    **values,
+                    "hit_rate": (
+                        round(values["hits"] / (values["hits"] + values["misses"]), 3)
+                        if values["hits"] + values["misses"]
+                        else None
+                    ),
+                }
+                for name, values in self.caches.items()
+            },
+        }
+
+    def as_json(self) -> str:
+        return json.dumps(self.summary())
+
+
+@contextmanager
+def profiled(path: str | None):
+    """
+    Runs the block under cProfile and dumps the stats to ``path`` in pstats
+    format, readable by snakeviz or convertible to a flamegraph with
+    flameprof. Does nothing when no path is given.
+    """
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
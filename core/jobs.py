@@ -0,0 +1,111 @@
+import io
+import logging
+import time
+import traceback
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from accountability.processors import ExcelProcessor
+from core.models import ImportJob
+from core.processors import BulkDataImporter
+
+logger = logging.getLogger(__name__)
+
+# seconds between the progress updates of a running job
+PROGRESS_INTERVAL = 1.0
+# missed progress updates after which a running job is considered abandoned
+# by a worker that crashed or was killed
+STALE_JOB_INTERVALS = 300
+
+
+def fail_stale_jobs() -> int:
+    """Marks as failed the running jobs that stopped reporting progress"""
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=PROGRESS_INTERVAL * STALE_JOB_INTERVALS)
+    count = ImportJob.objects.filter(
+        status=ImportJob.Status.running, updated_at__lt=stale_before
+    ).update(
+        status=ImportJob.Status.failed,
+        error="El proceso de importación se interrumpió sin finalizar.",
+        finished_at=now,
+        updated_at=now,
+    )
+    if count:
+        logger.warning(f"Marked {count} abandoned import jobs as failed")
+    return count
+
+
+def claim_next_job() -> ImportJob | None:
+    """
+    Marks the oldest pending job as running and returns it. Locked rows are
+    skipped so that several workers can share the queue. Running jobs
+    abandoned by a worker are failed first.
+    """
+    fail_stale_jobs()
+    with transaction.atomic():
+        job = (
+            ImportJob.objects.select_for_update(skip_locked=True)
+            .filter(status=ImportJob.Status.pending)
+            .order_by("created_at")
+            .first()
+        )
+        if not job:
+            return None
+        job.status = ImportJob.Status.running
+        job.started_at = timezone.now()
+        job.save(update_fields=["status", "started_at", "updated_at"])
+    return job
+
+
+class ProgressReporter:
+    """Saves the progress of a job at most once every ``interval`` seconds"""
+
+    def __init__(self, job: ImportJob, interval: float = PROGRESS_INTERVAL):
+        self.job = job
+        self.interval = interval
+        self.last_update = 0.0
+
+    def __call__(self, rows_done: int, rows_skipped: int):
+        now = time.monotonic()
+        if now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        ImportJob.objects.filter(pk=self.job.pk).update(
+            rows_done=rows_done, rows_skipped=rows_skipped, updated_at=timezone.now()
+        )
+
+
+def run_job(job: ImportJob):
+    logger.info(f"Running import job {job.pk} ({job.kind})")
+    progress = ProgressReporter(job)
+    try:
+        with job.file.open("rb") as file:
+            if job.kind == ImportJob.Kind.reports:
+                importer = ExcelProcessor(file, progress=progress)
+                try:
+                    skipped_rows = importer.process()
+                finally:
+                    importer.close()
+            else:
+                importer = BulkDataImporter(
+                    io.TextIOWrapper(file, encoding="utf-8-sig", newline=""),
+                    job.kind,
+                    progress=progress,
+                )
+                skipped_rows = importer.process()
+    except Exception:
+        logger.error(f"Import job {job.pk} failed", exc_info=True)
+        job.status = ImportJob.Status.failed
+        job.error = traceback.format_exc()
+    else:
+        job.status = ImportJob.Status.finished
+        job.rows_done = importer.rows_processed
+        job.rows_skipped = len(skipped_rows)
+        job.skipped_rows = [list(row) for row in skipped_rows]
+        job.stats = importer.stats.summary()
+    job.finished_at = timezone.now()
+    job.save()
+    logger.info(f"Import job {job.pk} {job.status}")
+    return job
@@ -1,8 +1,18 @@
+import time
 from argparse import FileType
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
 
-from core.processors import DataImporter
+from core.instrumentation import profiled
+from core.models import ImportCheckpoint
+from core.processors import (
+    DataImporter,
+    BulkDataImporter,
+    CopyDataImporter,
+    file_digest,
+    import_in_parallel,
+)
 
 
 class Command(BaseCommand):
@@ -15,13 +25,137 @@ class Command(BaseCommand):
             choices=["establishments", "institutions"],
         )
         parser.add_argument("import_file", nargs="?", type=FileType("r"))
+        parser.add_argument(
+            "--engine",
+            choices=["row", "bulk", "copy"],
+            default="bulk",
+            help="Import row by row, in batches of bulk statements or, for full "
+            "reloads on PostgreSQL, through a COPY staging table",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of rows written per batch when using the bulk engine",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue a previous import of the same file from its last "
+            "committed batch",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes importing department partitions in parallel",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report how many rows would be inserted, updated or left "
+            "unchanged without writing to the database",
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="PATH",
+            help="Write cProfile stats of the run to PATH (pstats format)",
+        )
 
     def handle(self, *args, **options):
-        importer = DataImporter(options["import_file"], options["import_type"])
+        with profiled(options["profile"]):
+            self.run(options)
+        if options["profile"]:
+            self.stdout.write(
+                self.style.SUCCESS(f"Profile written to {options['profile']}")
+            )
+
+    def run(self, options):
+        start = time.monotonic()
+        if options["workers"] > 1:
+            if options["engine"] != "bulk" or options["resume"]:
+                raise CommandError(
+                    "--workers is only available with the bulk engine and "
+                    "without --resume"
+                )
+            rows, skipped_lines, counts, stats = import_in_parallel(
+                options["import_file"],
+                options["import_type"],
+                options["workers"],
+                batch_size=options["batch_size"],
+                dry_run=options["dry_run"],
+            )
+            self.report(skipped_lines, rows, time.monotonic() - start)
+            self.report_counts(counts)
+            self.stdout.write(stats.as_json())
+            return
+        if options["engine"] != "bulk" and (options["resume"] or options["dry_run"]):
+            raise CommandError(
+                "--resume and --dry-run are only available with the bulk engine"
+            )
+        if options["engine"] == "copy":
+            if connection.vendor != "postgresql":
+                raise CommandError("The copy engine requires PostgreSQL")
+            importer = CopyDataImporter(options["import_file"], options["import_type"])
+        elif options["engine"] == "bulk":
+            checkpoint = None
+            if options["resume"] and not options["import_file"].seekable():
+                raise CommandError("--resume requires a file, not a stream")
+            # streams such as stdin cannot be hashed and read again
+            if not options["dry_run"] and options["import_file"].seekable():
+                checkpoint = self.get_checkpoint(options)
+                if checkpoint.finished:
+                    self.stdout.write(self.style.SUCCESS("File was already imported"))
+                    return
+            importer = BulkDataImporter(
+                options["import_file"],
+                options["import_type"],
+                batch_size=options["batch_size"],
+                checkpoint=checkpoint,
+                dry_run=options["dry_run"],
+            )
+        else:
+            importer = DataImporter(options["import_file"], options["import_type"])
         skipped_lines = importer.process()
+        self.report(skipped_lines, importer.rows_processed, time.monotonic() - start)
+        if options["engine"] == "bulk":
+            self.report_counts(importer.counts)
+        self.stdout.write(importer.stats.as_json())
+
+    def report_counts(self, counts):
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Inserted: {counts.get('inserted', 0)}. "
+                f"Updated: {counts.get('updated', 0)}. "
+                f"Unchanged: {counts.get('unchanged', 0)}."
+            )
+        )
+
+    def report(self, skipped_lines, rows, elapsed):
         if not skipped_lines:
             self.stdout.write(self.style.SUCCESS("No skipped lines"))
         for line in skipped_lines:
             self.stdout.write(
                 self.style.SUCCESS(f"Skipped line {line[0]}. Reason: {line[1]}")
             )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Processed {rows} rows in {elapsed:.1f}s "
+                f"({rows / elapsed if elapsed else rows:.0f} rows/sec)"
+            )
+        )
+
+    def get_checkpoint(self, options):
+        checkpoint, _ = ImportCheckpoint.objects.get_or_create(
+            file_hash=file_digest(options["import_file"]),
+            import_type=options["import_type"],
+        )
+        if not options["resume"]:
+            checkpoint.last_row = 0
+            checkpoint.finished = False
+            checkpoint.save()
+        elif checkpoint.last_row and not checkpoint.finished:
+            self.stdout.write(
+                self.style.SUCCESS(f"Resuming after line {checkpoint.last_row + 1}")
+            )
+        return checkpoint
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management import BaseCommand
+
+from core.instrumentation import profiled
+from core.jobs import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Processes queued import jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait before polling again when the queue is empty",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit when the queue is empty",
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="PATH",
+            help="Write cProfile stats of the run to PATH (pstats format)",
+        )
+
+    def handle(self, *args, **options):
+        with profiled(options["profile"]):
+            self.run(options)
+
+    def run(self, options):
+        self.stdout.write(self.style.SUCCESS("Waiting for import jobs"))
+        while True:
+            job = claim_next_job()
+            if not job:
+                if options["once"]:
+                    return
+                time.sleep(options["interval"])
+                continue
+            job = run_job(job)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Job {job.pk} {job.get_status_display()}: {job.rows_done} rows, "
+                    f"{job.rows_skipped} skipped"
+                )
+            )
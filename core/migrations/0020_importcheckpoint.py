@@ -0,0 +1,55 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0019_remove_institution_unique_establishment_institution_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "file_hash",
+                    models.CharField(max_length=64, verbose_name="hash del archivo"),
+                ),
+                (
+                    "import_type",
+                    models.CharField(max_length=20, verbose_name="tipo de importación"),
+                ),
+                (
+                    "last_row",
+                    models.PositiveIntegerField(default=0, verbose_name="última fila"),
+                ),
+                (
+                    "finished",
+                    models.BooleanField(default=False, verbose_name="finalizado"),
+                ),
+            ],
+            options={
+                "verbose_name": "punto de control de importación",
+                "verbose_name_plural": "puntos de control de importación",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="importcheckpoint",
+            constraint=models.UniqueConstraint(
+                fields=("file_hash", "import_type"), name="unique_import_checkpoint"
+            ),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0020_importcheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportFingerprint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "import_type",
+                    models.CharField(max_length=20, verbose_name="tipo de importación"),
+                ),
+                ("key", models.CharField(max_length=600, verbose_name="clave")),
+                ("digest", models.CharField(max_length=64, verbose_name="huella")),
+            ],
+            options={
+                "verbose_name": "huella de importación",
+                "verbose_name_plural": "huellas de importación",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="importfingerprint",
+            constraint=models.UniqueConstraint(
+                fields=("import_type", "key"), name="unique_import_fingerprint"
+            ),
+        ),
+    ]
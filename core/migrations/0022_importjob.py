@@ -0,0 +1,116 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("core", "0021_importfingerprint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("establishments", "Establecimientos"),
+                            ("institutions", "Instituciones"),
+                            ("reports", "Rendiciones"),
+                        ],
+                        max_length=20,
+                        verbose_name="tipo",
+                    ),
+                ),
+                ("file", models.FileField(upload_to="imports", verbose_name="archivo")),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pendiente"),
+                            ("running", "En proceso"),
+                            ("finished", "Finalizado"),
+                            ("failed", "Fallido"),
+                        ],
+                        default="pending",
+                        editable=False,
+                        max_length=20,
+                        verbose_name="estado",
+                    ),
+                ),
+                (
+                    "rows_done",
+                    models.PositiveIntegerField(
+                        default=0, editable=False, verbose_name="filas procesadas"
+                    ),
+                ),
+                (
+                    "rows_skipped",
+                    models.PositiveIntegerField(
+                        default=0, editable=False, verbose_name="filas omitidas"
+                    ),
+                ),
+                (
+                    "skipped_rows",
+                    models.JSONField(
+                        default=list, editable=False, verbose_name="filas omitidas"
+                    ),
+                ),
+                (
+                    "error",
+                    models.TextField(default="", editable=False, verbose_name="error"),
+                ),
+                (
+                    "started_at",
+                    models.DateTimeField(
+                        editable=False, null=True, verbose_name="iniciado el"
+                    ),
+                ),
+                (
+                    "finished_at",
+                    models.DateTimeField(
+                        editable=False, null=True, verbose_name="finalizado el"
+                    ),
+                ),
+                (
+                    "created_by",
+                    models.ForeignKey(
+                        editable=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="import_jobs",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="creado por",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "importación",
+                "verbose_name_plural": "importaciones",
+                "ordering": ("-created_at",),
+                "indexes": [
+                    models.Index(
+                        fields=["status", "created_at"],
+                        name="core_import_status_6f3c45_idx",
+                    )
+                ],
+            },
+        ),
+    ]
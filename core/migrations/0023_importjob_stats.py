@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0022_importjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="importjob",
+            name="stats",
+            field=models.JSONField(
+                default=dict, editable=False, verbose_name="estadísticas"
+            ),
+        ),
+    ]
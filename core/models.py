@@ -3,6 +3,10 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models import UniqueConstraint
+from django.dispatch import receiver
+from django.utils import timezone
+
+from core.cache import invalidate
 
 
 class ImportantDatesModel(models.Model):
@@ -224,3 +228,120 @@ class Resource(models.Model):
     def clean(self):
         if not self.url and not self.document:
             raise ValidationError("Debe agregar una URL o un documento.")
+
+
+class ImportCheckpoint(ImportantDatesModel):
+    file_hash = models.CharField(max_length=64, verbose_name="hash del archivo")
+    import_type = models.CharField(max_length=20, verbose_name="tipo de importación")
+    last_row = models.PositiveIntegerField(default=0, verbose_name="última fila")
+    finished = models.BooleanField(default=False, verbose_name="finalizado")
+
+    class Meta:
+        verbose_name = "punto de control de importación"
+        verbose_name_plural = "puntos de control de importación"
+        constraints = [
+            UniqueConstraint(
+                fields=("file_hash", "import_type"), name="unique_import_checkpoint"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.import_type} {self.file_hash[:8]}: {self.last_row}"
+
+
+class ImportFingerprint(ImportantDatesModel):
+    import_type = models.CharField(max_length=20, verbose_name="tipo de importación")
+    key = models.CharField(max_length=600, verbose_name="clave")
+    digest = models.CharField(max_length=64, verbose_name="huella")
+
+    class Meta:
+        verbose_name = "huella de importación"
+        verbose_name_plural = "huellas de importación"
+        constraints = [
+            UniqueConstraint(
+                fields=("import_type", "key"), name="unique_import_fingerprint"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.import_type} {self.key}"
+
+
+class ImportJob(ImportantDatesModel):
+    class Kind(models.TextChoices):
+        establishments = "establishments", "Establecimientos"
+        institutions = "institutions", "Instituciones"
+        reports = "reports", "Rendiciones"
+
+    class Status(models.TextChoices):
+        pending = "pending", "Pendiente"
+        running = "running", "En proceso"
+        finished = "finished", "Finalizado"
+        failed = "failed", "Fallido"
+
+    kind = models.CharField(max_length=20, choices=Kind.choices, verbose_name="tipo")
+    file = models.FileField(upload_to="imports", verbose_name="archivo")
+    status = models.CharField(
+        max_length=20,
+        choices=Status.choices,
+        default=Status.pending,
+        editable=False,
+        verbose_name="estado",
+    )
+    rows_done = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name="filas procesadas"
+    )
+    rows_skipped = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name="filas omitidas"
+    )
+    skipped_rows = models.JSONField(
+        default=list, editable=False, verbose_name="filas omitidas"
+    )
+    error = models.TextField(default="", editable=False, verbose_name="error")
+    stats = models.JSONField(default=dict, editable=False, verbose_name="estadísticas")
+    started_at = models.DateTimeField(
+        null=True, editable=False, verbose_name="iniciado el"
+    )
+    finished_at = models.DateTimeField(
+        null=True, editable=False, verbose_name="finalizado el"
+    )
+    created_by = models.ForeignKey(
+        "users.User",
+        on_delete=models.SET_NULL,
+        null=True,
+        editable=False,
+        related_name="import_jobs",
+        verbose_name="creado por",
+    )
+
+    class Meta:
+        verbose_name = "importación"
+        verbose_name_plural = "importaciones"
+        ordering = ("-created_at",)
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} ({self.created_at:%d/%m/%Y %H:%M})"
+
+    @property
+    def rows_per_second(self):
+        if not self.started_at:
+            return None
+        elapsed = (
+            (self.finished_at or timezone.now()) - self.started_at
+        ).total_seconds()
+        return round(self.rows_done / elapsed, 1) if elapsed else None
+
+
+@receiver(models.signals.post_save, sender=Department)
+@receiver(models.signals.post_delete, sender=Department)
+@receiver(models.signals.post_save, sender=District)
+@receiver(models.signals.post_delete, sender=District)
+@receiver(models.signals.post_save, sender=Locality)
+@receiver(models.signals.post_delete, sender=Locality)
+@receiver(models.signals.post_save, sender=Institution)
+@receiver(models.signals.post_delete, sender=Institution)
+@receiver(models.signals.post_save, sender=Establishment)
+@receiver(models.signals.post_delete, sender=Establishment)
+def invalidate_cached_aggregates(sender, **kwargs):
+    invalidate(sender)
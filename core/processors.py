@@ -1,15 +1,38 @@
 import csv
+import hashlib
+import io
+import json
 import logging
+import os
 import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
 from typing import IO, Literal, Callable
 
-from core.models import Department, District, Locality, Establishment, Institution
+import django
+from django.db import transaction, connections
+from django.utils import timezone
+
+from core.cache import invalidate
+from core.instrumentation import ImportStats
+from core.models import (
+    Department,
+    District,
+    Locality,
+    Establishment,
+    Institution,
+    ImportCheckpoint,
+    ImportFingerprint,
+)
 
 logger = logging.getLogger(__name__)
 
 
 class DataImporter:
+    # keys per DELETE statement, below the SQLite limit of query parameters
+    FORGET_BATCH_SIZE = 500
+
     def __init__(
         self, file: IO, import_type: Literal["establishments", "institutions"]
     ):
@@ -21,6 +44,9 @@ class DataImporter:
         self.establishments = {}
         self.reader = csv.DictReader(file)
         self.skipped_rows = []
+        self.rows_processed = 0
+        self.processed_keys = set()
+        self.stats = ImportStats()
 
     def process(self):
         logger.info(f"Processing file containing {self.import_type}")
@@ -30,13 +56,47 @@ class DataImporter:
             if self.import_type == "establishments"
             else self.process_institutions_row
         )
-        for idx, row in enumerate(self.reader):
-            processor(row, idx)
+        with self.stats.track_queries():
+            for idx, row in self.stats.timed_iter("parse", enumerate(self.reader)):
+                with self.stats.stage("rows"):
+                    processor(row, idx)
+                self.processed_keys.add(self._fingerprint_key(row))
+                self.rows_processed += 1
+            self.forget_fingerprints()
         logger.info(
             f"Finished processing {idx + 1} rows. Skipped {len(self.skipped_rows)} rows."
         )
+        self.log_stats()
         return self.skipped_rows
 
+    def log_stats(self):
+        logger.info(f"Import stats: {self.stats.as_json()}")
+
+    def _fingerprint_key(self, row) -> str:
+        establishment_code = row.get("codigo_establecimiento") or ""
+        if self.import_type == "establishments":
+            return establishment_code
+        return "-".join(
+            [
+                establishment_code,
+                row.get("codigo_institucion") or "",
+                row.get("nombre_institucion") or "",
+            ]
+        )
+
+    def forget_fingerprints(self):
+        """
+        Deletes the bulk importer fingerprints of the processed rows, which no
+        longer describe the stored rows once they are written without
+        comparing them
+        """
+        keys = list(self.processed_keys)
+        for start in range(0, len(keys), self.FORGET_BATCH_SIZE):
+            ImportFingerprint.objects.filter(
+                import_type=self.import_type,
+                key__in=keys[start : start + self.FORGET_BATCH_SIZE],
+            ).delete()
+
     def process_establishments_row(self, row, idx: int):
         department = self._get_department(row)
         if not department:
@@ -61,6 +121,7 @@ class DataImporter:
         if not code:
             self.skipped_rows.append((idx + 2, "Falta código establecimiento"))
         try:
+            self.stats.cache("establishments", code in self.establishments)
             if code not in self.establishments:
                 self.establishments[code] = Establishment.objects.get(code=code)
         except Establishment.DoesNotExist:
@@ -75,12 +136,18 @@ class DataImporter:
             return
         return institution
 
-    def _get_department(self, row):
+    @staticmethod
+    def _department_code(row):
         code = row.get("codigo_departamento")
+        if code and len(code) < 2:
+            code = f"0{code}"
+        return code
+
+    def _get_department(self, row):
+        code = self._department_code(row)
         if not code:
             return
-        if len(code) < 2:
-            code = f"0{code}"
+        self.stats.cache("departments", code in self.departments)
         if code not in self.departments:
             self.departments[code], _ = Department.objects.update_or_create(
                 code=code, defaults={"name": row.get("nombre_departamento", "")}
@@ -93,6 +160,7 @@ class DataImporter:
         if not department or not code:
             return
         key = f"{department.code}-{code}"
+        self.stats.cache("districts", key in self.districts)
         if key not in self.districts:
             self.districts[key], _ = District.objects.update_or_create(
                 code=code,
@@ -109,6 +177,7 @@ class DataImporter:
         if not district or not code:
             return
         key = f"{district.department.code}-{district.code}-{code}"
+        self.stats.cache("localities", key in self.localities)
         if key not in self.localities:
             self.localities[key], _ = Locality.objects.update_or_create(
                 code=code,
@@ -124,6 +193,9 @@ class DataImporter:
         if not code:
             return
         if code not in self.establishments:
+            with self.stats.stage("convert_coordinate"):
+                latitude = self.convert_coordinate(row.get("latitud", ""))
+                longitude = self.convert_coordinate(row.get("longitud", ""))
             self.establishments[code], _ = Establishment.objects.update_or_create(
                 code=code,
                 defaults={
@@ -133,22 +205,25 @@ class DataImporter:
                     "zone_code": row.get("codigo_zona", ""),
                     "zone_name": row.get("nombre_zona", ""),
                     "address": row.get("direccion", ""),
-                    "latitude": self.convert_coordinate(row.get("latitud", "")),
-                    "longitude": self.convert_coordinate(row.get("longitud", "")),
+                    "latitude": latitude,
+                    "longitude": longitude,
                 },
             )
         return self.establishments[code]
 
     @staticmethod
-    def _get_institution(row, establishment: Establishment):
-        code = row.get("codigo_institucion").replace(".", "").replace(" ", "")
+    def _institution_code(row) -> int:
+        code = (row.get("codigo_institucion") or "").replace(".", "").replace(" ", "")
         if not code:
             raise ValueError("Falta código institución")
         try:
-            code = abs(int(code))
+            return abs(int(code))
         except ValueError:
             raise ValueError("Código inválido")
 
+    @classmethod
+    def _get_institution(cls, row, establishment: Establishment):
+        code = cls._institution_code(row)
         institution, _ = Institution.objects.update_or_create(
             code=code,
             establishment=establishment,
@@ -183,3 +258,860 @@ class DataImporter:
             )
         except ValueError:
             return
+
+
+def file_digest(file: IO) -> str:
+    """Returns the SHA-256 of a text file and rewinds it"""
+    digest = hashlib.sha256()
+    for line in file:
+        digest.update(line.encode())
+    file.seek(0)
+    return digest.hexdigest()
+
+
+class BulkDataImporter(DataImporter):
+    """
+    Imports establishments or institutions in batches.
+
+    The existing geographic hierarchy and institutions are loaded once into
+    keyed dictionaries. Each batch of rows is then resolved against them and
+    every level (departments, districts, localities, establishments and
+    institutions) is written with a single bulk statement, in dependency order.
+
+    When a checkpoint is given, each batch is committed in its own transaction
+    together with the number of rows consumed so far, and rows already covered
+    by the checkpoint are skipped, so an interrupted import can be resumed.
+
+    A fingerprint of every imported row is stored by establishment or
+    institution key; rows whose content did not change since the previous
+    import are not written again. With ``dry_run`` rows are only classified as
+    inserted, updated or unchanged and nothing is written.
+    """
+
+    COORDINATE_PRECISION = Decimal("1e-8")
+
+    def __init__(
+        self,
+        file: IO,
+        import_type: Literal["establishments", "institutions"],
+        batch_size: int = 1000,
+        checkpoint: ImportCheckpoint | None = None,
+        dry_run: bool = False,
+        progress: Callable[[int, int], None] | None = None,
+    ):
+        super().__init__(file, import_type)
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.dry_run = dry_run
+        self.progress = progress
+        self.institutions = {}
+        self.batch = []
+        self.batch_fingerprints = {}
+        self.counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        with self.stats.track_queries(), self.stats.stage("load_caches"):
+            self.load_caches()
+
+    def load_caches(self):
+        self.departments = {obj.code: obj for obj in Department.objects.all()}
+        departments = {obj.id: obj for obj in self.departments.values()}
+        districts = {}
+        for obj in District.objects.all():
+            obj.department = departments[obj.department_id]
+            districts[obj.id] = obj
+            self.districts[self._district_key(obj.department.code, obj.code)] = obj
+        for obj in Locality.objects.all():
+            obj.district = districts[obj.district_id]
+            self.localities[
+                self._locality_key(
+                    obj.district.department.code, obj.district.code, obj.code
+                )
+            ] = obj
+        establishments = {}
+        for obj in Establishment.objects.all():
+            establishments[obj.id] = obj
+            self.establishments[obj.code] = obj
+        if self.import_type == "institutions":
+            for obj in Institution.objects.all():
+                establishment = establishments[obj.establishment_id]
+                self.institutions[(establishment.code, obj.code, obj.name)] = obj
+        self.fingerprints = dict(
+            ImportFingerprint.objects.filter(import_type=self.import_type).values_list(
+                "key", "digest"
+            )
+        )
+
+    @staticmethod
+    def _fingerprint(row) -> str:
+        # only the header fields, in header order: cells beyond them are
+        # grouped under a None key, which cannot be sorted
+        values = [value for field, value in row.items() if field is not None]
+        content = json.dumps(values, ensure_ascii=False)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _exists(self, row) -> bool:
+        code = row.get("codigo_establecimiento")
+        if self.import_type == "establishments":
+            return code in self.establishments
+        try:
+            institution_code = str(self._institution_code(row))
+        except ValueError:
+            return False
+        key = (code, institution_code, row.get("nombre_institucion", ""))
+        return key in self.institutions
+
+    def _detect_change(self, idx, row) -> bool:
+        """Returns whether the row changed since it was last imported"""
+        key = self._fingerprint_key(row)
+        digest = self._fingerprint(row)
+        exists = self._exists(row)
+        # rows deleted since the previous import are written again
+        unchanged = exists and self.fingerprints.get(key) == digest
+        self.stats.cache("fingerprints", unchanged)
+        if unchanged:
+            self.counts["unchanged"] += 1
+            return False
+        kind = "updated" if exists else "inserted"
+        self.fingerprints[key] = digest
+        self.batch_fingerprints[idx] = (key, digest, kind)
+        return True
+
+    def iter_rows(self):
+        start = self.checkpoint.last_row if self.checkpoint else 0
+        for idx, row in enumerate(self.reader):
+            if idx >= start:
+                yield idx, row
+
+    def process(self):
+        logger.info(f"Processing file containing {self.import_type} in bulk mode")
+        with self.stats.track_queries():
+            for idx, row in self.stats.timed_iter("parse", self.iter_rows()):
+                self.rows_processed += 1
+                if self.progress and self.rows_processed % self.batch_size == 0:
+                    self.progress(self.rows_processed, len(self.skipped_rows))
+                with self.stats.stage("fingerprint"):
+                    changed = self._detect_change(idx, row)
+                if not changed:
+                    continue
+                self.batch.append((idx, row))
+                if len(self.batch) >= self.batch_size:
+                    self.flush()
+            self.flush()
+        if self.progress:
+            self.progress(self.rows_processed, len(self.skipped_rows))
+        if self.checkpoint and not self.dry_run:
+            self.checkpoint.finished = True
+            self.checkpoint.save(update_fields=["finished", "updated_at"])
+        logger.info(
+            f"Finished processing {self.rows_processed} rows. "
+            f"Skipped {len(self.skipped_rows)} rows. "
+            f"Inserted {self.counts['inserted']}, updated {self.counts['updated']}, "
+            f"unchanged {self.counts['unchanged']}."
+        )
+        self.log_stats()
+        return self.skipped_rows
+
+    def flush(self):
+        if not self.batch:
+            return
+        skipped_count = len(self.skipped_rows)
+        if self.dry_run:
+            with self.stats.stage("validate"):
+                self._validate_batch(self.batch)
+            self._count_changes(skipped_count)
+            self.batch = []
+            self.batch_fingerprints = {}
+            return
+        with transaction.atomic():
+            with self.stats.stage("validate"):
+                hierarchy_rows, institution_rows = self._validate_batch(self.batch)
+            with self.stats.stage("write_departments"):
+                self._write_departments(hierarchy_rows)
+            with self.stats.stage("write_districts"):
+                self._write_districts(hierarchy_rows)
+            with self.stats.stage("write_localities"):
+                self._write_localities(hierarchy_rows)
+            with self.stats.stage("write_establishments"):
+                self._write_establishments(hierarchy_rows)
+            if institution_rows:
+                with self.stats.stage("write_institutions"):
+                    self._write_institutions(institution_rows)
+            with self.stats.stage("write_fingerprints"):
+                self._write_fingerprints(self._count_changes(skipped_count))
+            if self.checkpoint:
+                self.checkpoint.last_row = self.batch[-1][0] + 1
+                self.checkpoint.save(update_fields=["last_row", "updated_at"])
+        self.batch = []
+        self.batch_fingerprints = {}
+
+    def _count_changes(self, skipped_count: int) -> list[tuple[str, str]]:
+        """
+        Counts the inserted and updated rows of the batch, leaving out the ones
+        skipped by validation, and returns their fingerprints.
+        """
+        skipped = {line - 2 for line, _ in self.skipped_rows[skipped_count:]}
+        fingerprints = []
+        for idx, (key, digest, kind) in self.batch_fingerprints.items():
+            if idx not in skipped:
+                self.counts[kind] += 1
+                fingerprints.append((key, digest))
+        return fingerprints
+
+    def _write_fingerprints(self, fingerprints: list[tuple[str, str]]):
+        # skipped rows keep no fingerprint so they are reported again next time
+        fingerprints = [
+            ImportFingerprint(import_type=self.import_type, key=key, digest=digest)
+            for key, digest in fingerprints
+        ]
+        ImportFingerprint.objects.bulk_create(
+            fingerprints,
+            batch_size=self.batch_size,
+            update_conflicts=True,
+            unique_fields=["import_type", "key"],
+            update_fields=["digest", "updated_at"],
+        )
+
+    @staticmethod
+    def _district_key(department_code, code):
+        return f"{department_code}-{code}"
+
+    @staticmethod
+    def _locality_key(department_code, district_code, code):
+        return f"{department_code}-{district_code}-{code}"
+
+    def _validate_batch(self, batch):
+        """
+        Splits the batch into rows whose establishment (and parents) must be
+        written and rows carrying an institution, recording skipped rows with
+        the same reasons as the row by row importer.
+        """
+        hierarchy_rows = []
+        institution_rows = []
+        pending_establishments = set()
+        for idx, row in batch:
+            code = row.get("codigo_establecimiento")
+            if (
+                self.import_type == "institutions"
+                and code
+                and (code in self.establishments or code in pending_establishments)
+            ):
+                self._validate_institution(idx, row, institution_rows)
+                continue
+            if not self._department_code(row):
+                self.skipped_rows.append((idx + 2, "Falta código departamento"))
+                continue
+            if not row.get("codigo_distrito"):
+                self.skipped_rows.append((idx + 2, "Falta código distrito"))
+                continue
+            if not row.get("codigo_barrio_localidad"):
+                self.skipped_rows.append((idx + 2, "Falta código barrio/localidad"))
+                continue
+            if not code:
+                self.skipped_rows.append((idx + 2, "Falta código establecimiento"))
+                continue
+            hierarchy_rows.append(row)
+            pending_establishments.add(code)
+            if self.import_type == "institutions":
+                self._validate_institution(idx, row, institution_rows)
+        return hierarchy_rows, institution_rows
+
+    def _validate_institution(self, idx, row, institution_rows):
+        try:
+            code = self._institution_code(row)
+        except ValueError as exc:
+            self.skipped_rows.append((idx + 2, str(exc)))
+            return
+        institution_rows.append((str(code), row))
+
+    def _stage(self, name, cache, key, values, build, new, changed):
+        """
+        Queues a missing object for creation or an existing one for update when
+        any of its values differ. Each key is only staged once per run.
+        """
+        obj = cache.get(key)
+        self.stats.cache(name, obj is not None)
+        if obj is None:
+            new[key] = build(**values)
+            return
+        if getattr(obj, "_staged", False):
+            return
+        obj._staged = True
+        if any(getattr(obj, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(obj, field, value)
+            changed.append(obj)
+
+    def _write(self, model, new, changed, unique_fields, update_fields, refetch, key):
+        """
+        Writes staged objects and returns the newly created ones, reloaded so
+        that their primary keys are available to the following levels.
+        """
+        created = []
+        if new:
+            model.objects.bulk_create(
+                list(new.values()),
+                batch_size=self.batch_size,
+                update_conflicts=True,
+                unique_fields=unique_fields,
+                update_fields=update_fields + ["updated_at"],
+            )
+            created = [obj for obj in refetch(new.values()) if key(obj) in new]
+            for obj in created:
+                obj._staged = True
+        if changed:
+            now = timezone.now()
+            for obj in changed:
+                obj.updated_at = now
+            model.objects.bulk_update(
+                changed, update_fields + ["updated_at"], batch_size=self.batch_size
+            )
+        if new or changed:
+            # bulk writes do not send the signals that invalidate cached aggregates
+            invalidate(model)
+        return created
+
+    def _write_departments(self, rows):
+        new, changed = {}, []
+        for row in rows:
+            code = self._department_code(row)
+            if code in new:
+                continue
+            self._stage(
+                "departments",
+                self.departments,
+                code,
+                {"code": code, "name": row.get("nombre_departamento", "")},
+                Department,
+                new,
+                changed,
+            )
+        for obj in self._write(
+            Department,
+            new,
+            changed,
+            ["code"],
+            ["name"],
+            lambda objs: Department.objects.filter(code__in=[o.code for o in objs]),
+            lambda obj: obj.code,
+        ):
+            self.departments[obj.code] = obj
+
+    def _write_districts(self, rows):
+        new, changed = {}, []
+        for row in rows:
+            department = self.departments[self._department_code(row)]
+            code = row["codigo_distrito"]
+            key = self._district_key(department.code, code)
+            if key in new:
+                continue
+            self._stage(
+                "districts",
+                self.districts,
+                key,
+                {
+                    "code": code,
+                    "department_id": department.id,
+                    "name": row.get("nombre_distrito", ""),
+                },
+                District,
+                new,
+                changed,
+            )
+        for obj in self._write(
+            District,
+            new,
+            changed,
+            ["code", "department"],
+            ["name"],
+            lambda objs: District.objects.filter(
+                department_id__in={o.department_id for o in objs},
+                code__in={o.code for o in objs},
+            ).select_related("department"),
+            lambda obj: self._district_key(obj.department.code, obj.code),
+        ):
+            self.districts[self._district_key(obj.department.code, obj.code)] = obj
+
+    def _write_localities(self, rows):
+        new, changed = {}, []
+        for row in rows:
+            department_code = self._department_code(row)
+            district = self.districts[
+                self._district_key(department_code, row["codigo_distrito"])
+            ]
+            code = row["codigo_barrio_localidad"]
+            key = self._locality_key(department_code, district.code, code)
+            if key in new:
+                continue
+            self._stage(
+                "localities",
+                self.localities,
+                key,
+                {
+                    "code": code,
+                    "district_id": district.id,
+                    "name": row.get("nombre_barrio_localidad", ""),
+                },
+                Locality,
+                new,
+                changed,
+            )
+        for obj in self._write(
+            Locality,
+            new,
+            changed,
+            ["code", "district"],
+            ["name"],
+            lambda objs: Locality.objects.filter(
+                district_id__in={o.district_id for o in objs},
+                code__in={o.code for o in objs},
+            ).select_related("district__department"),
+            lambda obj: self._locality_key(
+                obj.district.department.code, obj.district.code, obj.code
+            ),
+        ):
+            self.localities[
+                self._locality_key(
+                    obj.district.department.code, obj.district.code, obj.code
+                )
+            ] = obj
+
+    def _establishment_values(self, row):
+        department_code = self._department_code(row)
+        district = self.districts[
+            self._district_key(department_code, row["codigo_distrito"])
+        ]
+        locality = self.localities[
+            self._locality_key(
+                department_code, district.code, row["codigo_barrio_localidad"]
+            )
+        ]
+        return {
+            "code": row["codigo_establecimiento"],
+            "last_data_capture": self._to_int(row.get("anio")),
+            "district_id": district.id,
+            "locality_id": locality.id,
+            "zone_code": row.get("codigo_zona", ""),
+            "zone_name": row.get("nombre_zona", ""),
+            "address": row.get("direccion", ""),
+            "latitude": self._to_coordinate(row.get("latitud", "")),
+            "longitude": self._to_coordinate(row.get("longitud", "")),
+        }
+
+    def _write_establishments(self, rows):
+        new, changed = {}, []
+        for row in rows:
+            code = row["codigo_establecimiento"]
+            if code in new:
+                continue
+            if self.import_type == "institutions" and code in self.establishments:
+                continue
+            self._stage(
+                "establishments",
+                self.establishments,
+                code,
+                self._establishment_values(row),
+                Establishment,
+                new,
+                changed,
+            )
+        update_fields = [
+            "last_data_capture",
+            "district",
+            "locality",
+            "zone_code",
+            "zone_name",
+            "address",
+            "latitude",
+            "longitude",
+        ]
+        for obj in self._write(
+            Establishment,
+            new,
+            changed,
+            ["code"],
+            update_fields,
+            lambda objs: Establishment.objects.filter(code__in=[o.code for o in objs]),
+            lambda obj: obj.code,
+        ):
+            self.establishments[obj.code] = obj
+
+    def _write_institutions(self, rows):
+        new, changed = {}, []
+        for code, row in rows:
+            establishment = self.establishments[row["codigo_establecimiento"]]
+            name = row.get("nombre_institucion", "")
+            key = (establishment.code, code, name)
+            if key in new:
+                continue
+            self._stage(
+                "institutions",
+                self.institutions,
+                key,
+                {
+                    "code": code,
+                    "establishment_id": establishment.id,
+                    "name": name,
+                    "institution_type": row.get("sector_o_tipo_gestion", "DESCONOCIDO"),
+                    "phone_number": row.get("nro_telefono", ""),
+                    "website": row.get("paginaweb", ""),
+                    "email": row.get("email", ""),
+                },
+                Institution,
+                new,
+                changed,
+            )
+        for obj in self._write(
+            Institution,
+            new,
+            changed,
+            ["code", "establishment", "name"],
+            ["institution_type", "phone_number", "website", "email"],
+            lambda objs: Institution.objects.filter(
+                establishment_id__in={o.establishment_id for o in objs},
+                code__in={o.code for o in objs},
+            ).select_related("establishment"),
+            lambda obj: (obj.establishment.code, obj.code, obj.name),
+        ):
+            self.institutions[(obj.establishment.code, obj.code, obj.name)] = obj
+
+    @staticmethod
+    def _to_int(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def _to_coordinate(self, value):
+        with self.stats.stage("convert_coordinate"):
+            coordinate = self.convert_coordinate(value)
+        if coordinate is None:
+            return None
+        return coordinate.quantize(self.COORDINATE_PRECISION)
+
+
+class PartitionImporter(BulkDataImporter):
+    """Bulk importer fed with an already read list of ``(index, row)`` pairs"""
+
+    def __init__(
+        self,
+        rows: list[tuple[int, dict]],
+        import_type: Literal["establishments", "institutions"],
+        batch_size: int = 1000,
+        dry_run: bool = False,
+    ):
+        super().__init__(
+            io.StringIO(), import_type, batch_size=batch_size, dry_run=dry_run
+        )
+        self.rows = rows
+
+    def iter_rows(self):
+        return iter(self.rows)
+
+
+def partition_by_department(file: IO) -> dict[str, list[tuple[int, dict]]]:
+    """
+    Groups the rows of a CSV file by department code. Rows from different
+    departments never share departments, districts or localities, so each
+    partition can be imported independently.
+    """
+    partitions = defaultdict(list)
+    for idx, row in enumerate(csv.DictReader(file)):
+        partitions[DataImporter._department_code(row) or ""].append((idx, row))
+    return partitions
+
+
+def _init_worker():
+    django.setup()
+
+
+def _import_partition(rows, import_type, batch_size, dry_run):
+    try:
+        importer = PartitionImporter(
+            rows, import_type, batch_size=batch_size, dry_run=dry_run
+        )
+        skipped_rows = importer.process()
+        return (
+            importer.rows_processed,
+            skipped_rows,
+            importer.counts,
+            importer.stats.summary(),
+        )
+    finally:
+        connections.close_all()
+
+
+def import_in_parallel(
+    file: IO,
+    import_type: Literal["establishments", "institutions"],
+    workers: int,
+    batch_size: int = 1000,
+    dry_run: bool = False,
+) -> tuple[int, list, dict, ImportStats]:
+    """
+    Imports a CSV file partitioned by department in a pool of processes, each
+    one with its own database connection and caches. Returns the number of
+    processed rows, the merged skipped rows, ordered by line, the merged
+    inserted/updated/unchanged counts and the merged stats of the workers.
+    """
+    partitions = partition_by_department(file)
+    logger.info(
+        f"Importing {len(partitions)} department partitions with {workers} workers"
+    )
+    # connections must not be shared with the forked workers
+    connections.close_all()
+    rows_processed = 0
+    skipped_rows = []
+    counts = defaultdict(int)
+    stats = ImportStats()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = [
+            pool.submit(_import_partition, rows, import_type, batch_size, dry_run)
+            for rows in partitions.values()
+        ]
+        for future in futures:
+            rows, skipped, partition_counts, summary = future.result()
+            stats.merge(summary)
+            rows_processed += rows
+            skipped_rows.extend(skipped)
+            for name, count in partition_counts.items():
+                counts[name] += count
+    return rows_processed, sorted(skipped_rows), dict(counts), stats
+
+
+class CopyDataImporter(BulkDataImporter):
+    """
+    PostgreSQL only importer for full reloads.
+
+    Rows are validated with the same rules as the bulk importer and streamed
+    with ``COPY FROM STDIN`` into an unlogged staging table. Departments,
+    districts, localities, establishments and institutions are then upserted
+    from it with one ``INSERT ... ON CONFLICT`` statement each.
+    """
+
+    STAGING_COLUMNS = (
+        ("line", "integer"),
+        ("has_hierarchy", "boolean"),
+        ("department_code", "text"),
+        ("department_name", "text"),
+        ("district_code", "text"),
+        ("district_name", "text"),
+        ("locality_code", "text"),
+        ("locality_name", "text"),
+        ("establishment_code", "text"),
+        ("last_data_capture", "bigint"),
+        ("zone_code", "text"),
+        ("zone_name", "text"),
+        ("address", "text"),
+        ("latitude", "numeric(12, 8)"),
+        ("longitude", "numeric(12, 8)"),
+        ("institution_code", "text"),
+        ("institution_name", "text"),
+        ("institution_type", "text"),
+        ("phone_number", "text"),
+        ("website", "text"),
+        ("email", "text"),
+    )
+
+    def __init__(
+        self, file: IO, import_type: Literal["establishments", "institutions"]
+    ):
+        super().__init__(file, import_type)
+        self.staging_table = f"core_import_staging_{os.getpid()}"
+
+    def load_caches(self):
+        # only the existing establishment codes are needed for validation
+        self.establishments = dict.fromkeys(
+            Establishment.objects.values_list("code", flat=True)
+        )
+
+    def _staging_values(self, idx, row, has_hierarchy, institution_code):
+        return (
+            idx + 2,
+            has_hierarchy,
+            self._department_code(row),
+            row.get("nombre_departamento", ""),
+            row.get("codigo_distrito"),
+            row.get("nombre_distrito", ""),
+            row.get("codigo_barrio_localidad"),
+            row.get("nombre_barrio_localidad", ""),
+            row.get("codigo_establecimiento"),
+            self._to_int(row.get("anio")),
+            row.get("codigo_zona", ""),
+            row.get("nombre_zona", ""),
+            row.get("direccion", ""),
+            self._to_coordinate(row.get("latitud", "")),
+            self._to_coordinate(row.get("longitud", "")),
+            institution_code,
+            row.get("nombre_institucion", ""),
+            row.get("sector_o_tipo_gestion", "DESCONOCIDO"),
+            row.get("nro_telefono", ""),
+            row.get("paginaweb", ""),
+            row.get("email", ""),
+        )
+
+    def process(self):
+        connection = connections["default"]
+        if connection.vendor != "postgresql":
+            raise ValueError("The copy engine requires PostgreSQL")
+        logger.info(f"Processing file containing {self.import_type} with COPY")
+        columns = ", ".join(name for name, _ in self.STAGING_COLUMNS)
+        definition = ", ".join(f"{name} {kind}" for name, kind in self.STAGING_COLUMNS)
+        with self.stats.track_queries(), connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE UNLOGGED TABLE IF NOT EXISTS {self.staging_table} "
+                f"({definition})"
+            )
+            cursor.execute(f"TRUNCATE {self.staging_table}")
+            fingerprints = {}
+            try:
+                with cursor.copy(
+                    f"COPY {self.staging_table} ({columns}) FROM STDIN"
+                ) as copy:
+                    for idx, row in self.stats.timed_iter("parse", self.iter_rows()):
+                        self.rows_processed += 1
+                        with self.stats.stage("validate"):
+                            values = self._validate_row(idx, row)
+                        if values:
+                            with self.stats.stage("copy"):
+                                copy.write_row(values)
+                            fingerprints[self._fingerprint_key(row)] = (
+                                self._fingerprint(row)
+                            )
+                with transaction.atomic(), self.stats.stage("upsert"):
+                    for statement in self.upsert_statements():
+                        cursor.execute(statement)
+                    # so that a later bulk import skips the rows loaded here
+                    with self.stats.stage("write_fingerprints"):
+                        self._write_fingerprints(list(fingerprints.items()))
+                invalidate(Department, District, Locality, Establishment, Institution)
+            finally:
+                cursor.execute(f"DROP TABLE IF EXISTS {self.staging_table}")
+        logger.info(
+            f"Finished processing {self.rows_processed} rows. "
+            f"Skipped {len(self.skipped_rows)} rows."
+        )
+        self.log_stats()
+        return self.skipped_rows
+
+    def _validate_row(self, idx, row):
+        hierarchy_rows, institution_rows = self._validate_batch([(idx, row)])
+        if not hierarchy_rows and not institution_rows:
+            return None
+        if hierarchy_rows:
+            # later rows of a new establishment only carry their institution
+            self.establishments.setdefault(row["codigo_establecimiento"], None)
+        institution_code = institution_rows[0][0] if institution_rows else None
+        return self._staging_values(idx, row, bool(hierarchy_rows), institution_code)
+
+    def upsert_statements(self):
+        staging = self.staging_table
+        department = Department._meta.db_table
+        district = District._meta.db_table
+        locality = Locality._meta.db_table
+        establishment = Establishment._meta.db_table
+        institution = Institution._meta.db_table
+        if self.import_type == "establishments":
+            on_establishment_conflict = f"""
+                DO UPDATE SET
+                    last_data_capture = EXCLUDED.last_data_capture,
+                    district_id = EXCLUDED.district_id,
+                    locality_id = EXCLUDED.locality_id,
+                    zone_code = EXCLUDED.zone_code,
+                    zone_name = EXCLUDED.zone_name,
+                    address = EXCLUDED.address,
+                    latitude = EXCLUDED.latitude,
+                    longitude = EXCLUDED.longitude,
+                    updated_at = EXCLUDED.updated_at
+                WHERE ({establishment}.last_data_capture, {establishment}.district_id,
+                       {establishment}.locality_id, {establishment}.zone_code,
+                       {establishment}.zone_name, {establishment}.address,
+                       {establishment}.latitude, {establishment}.longitude)
+                    IS DISTINCT FROM
+                      (EXCLUDED.last_data_capture, EXCLUDED.district_id,
+                       EXCLUDED.locality_id, EXCLUDED.zone_code, EXCLUDED.zone_name,
+                       EXCLUDED.address, EXCLUDED.latitude, EXCLUDED.longitude)
+            """
+        else:
+            # the institutions file does not update existing establishments
+            on_establishment_conflict = "DO NOTHING"
+        yield f"""
+            INSERT INTO {department} (code, name, created_at, updated_at)
+            SELECT DISTINCT ON (s.department_code)
+                s.department_code, s.department_name, now(), now()
+            FROM {staging} s
+            WHERE s.has_hierarchy
+            ORDER BY s.department_code, s.line
+            ON CONFLICT (code) DO UPDATE SET
+                name = EXCLUDED.name, updated_at = EXCLUDED.updated_at
+            WHERE {department}.name IS DISTINCT FROM EXCLUDED.name
+        """
+        yield f"""
+            INSERT INTO {district} (code, name, department_id, created_at, updated_at)
+            SELECT DISTINCT ON (d.id, s.district_code)
+                s.district_code, s.district_name, d.id, now(), now()
+            FROM {staging} s
+            JOIN {department} d ON d.code = s.department_code
+            WHERE s.has_hierarchy
+            ORDER BY d.id, s.district_code, s.line
+            ON CONFLICT (code, department_id) DO UPDATE SET
+                name = EXCLUDED.name, updated_at = EXCLUDED.updated_at
+            WHERE {district}.name IS DISTINCT FROM EXCLUDED.name
+        """
+        yield f"""
+            INSERT INTO {locality} (code, name, district_id, created_at, updated_at)
+            SELECT DISTINCT ON (di.id, s.locality_code)
+                s.locality_code, s.locality_name, di.id, now(), now()
+            FROM {staging} s
+            JOIN {department} d ON d.code = s.department_code
+            JOIN {district} di
+                ON di.department_id = d.id AND di.code = s.district_code
+            WHERE s.has_hierarchy
+            ORDER BY di.id, s.locality_code, s.line
+            ON CONFLICT (code, district_id) DO UPDATE SET
+                name = EXCLUDED.name, updated_at = EXCLUDED.updated_at
+            WHERE {locality}.name IS DISTINCT FROM EXCLUDED.name
+        """
+        yield f"""
+            INSERT INTO {establishment} (
+                code, last_data_capture, district_id, locality_id, zone_code,
+                zone_name, address, latitude, longitude, created_at, updated_at
+            )
+            SELECT DISTINCT ON (s.establishment_code)
+                s.establishment_code, s.last_data_capture, di.id, l.id,
+                s.zone_code, s.zone_name, s.address, s.latitude, s.longitude,
+                now(), now()
+            FROM {staging} s
+            JOIN {department} d ON d.code = s.department_code
+            JOIN {district} di
+                ON di.department_id = d.id AND di.code = s.district_code
+            JOIN {locality} l
+                ON l.district_id = di.id AND l.code = s.locality_code
+            WHERE s.has_hierarchy
+            ORDER BY s.establishment_code, s.line
+            ON CONFLICT (code) {on_establishment_conflict}
+        """
+        if self.import_type == "establishments":
+            return
+        yield f"""
+            INSERT INTO {institution} (
+                code, name, establishment_id, institution_type, phone_number,
+                website, email, created_at, updated_at
+            )
+            SELECT DISTINCT ON (e.id, s.institution_code, s.institution_name)
+                s.institution_code, s.institution_name, e.id, s.institution_type,
+                s.phone_number, s.website, s.email, now(), now()
+            FROM {staging} s
+            JOIN {establishment} e ON e.code = s.establishment_code
+            WHERE s.institution_code IS NOT NULL
+            ORDER BY e.id, s.institution_code, s.institution_name, s.line
+            ON CONFLICT (code, establishment_id, name) DO UPDATE SET
+                institution_type = EXCLUDED.institution_type,
+                phone_number = EXCLUDED.phone_number,
+                website = EXCLUDED.website,
+                email = EXCLUDED.email,
+                updated_at = EXCLUDED.updated_at
+            WHERE ({institution}.institution_type, {institution}.phone_number,
+                   {institution}.website, {institution}.email)
+                IS DISTINCT FROM
+                  (EXCLUDED.institution_type, EXCLUDED.phone_number,
+                   EXCLUDED.website, EXCLUDED.email)
+        """
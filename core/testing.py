@@ -0,0 +1,103 @@
+import json
+from datetime import date
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from accountability.models import (
+    AccountObject,
+    Disbursement,
+    DisbursementOrigin,
+    OriginDetail,
+    PaymentType,
+    Provider,
+    Receipt,
+    ReceiptItem,
+    ReceiptType,
+    Report,
+    Resolution,
+)
+from core.cache import cache
+from core.models import Department, District, Establishment, Institution, Locality
+
+
+def create_institution_data(index: int) -> dict:
+    """
+    Creates an institution with one disbursement of 1000, its report and one
+    receipt with a single item of 2 x 400, and returns the created objects
+    """
+    department = Department.objects.create(code=f"D{index}", name=f"Depto {index}")
+    district = District.objects.create(
+        code="1", name=f"Distrito {index}", department=department
+    )
+    locality = Locality.objects.create(
+        code="1", name=f"Localidad {index}", district=district
+    )
+    establishment = Establishment.objects.create(
+        code=f"E{index}", district=district, locality=locality
+    )
+    institution = Institution.objects.create(
+        establishment=establishment,
+        code=str(index),
+        name=f"Escuela {index}",
+        institution_type="OFICIAL",
+    )
+    disbursement = Disbursement.objects.create(
+        resolution=Resolution.objects.create(document_number=index, document_year=2023),
+        institution=institution,
+        disbursement_date=date(2023, 3, 1),
+        amount_disbursed=1000,
+        funds_origin=DisbursementOrigin.objects.create(code=index),
+        origin_details=OriginDetail.objects.create(name=f"Marco {index}"),
+        payment_type=PaymentType.objects.create(name=f"Pago {index}"),
+    )
+    report = Report.objects.create(
+        disbursement=disbursement, report_date=date(2023, 6, 1), delivered_via="RUE"
+    )
+    receipt = Receipt.objects.create(
+        report=report,
+        receipt_type=ReceiptType.objects.create(name=f"Factura {index}"),
+        receipt_number=f"001-{index}",
+        receipt_date=date(2023, 5, 1),
+        provider=Provider.objects.create(ruc=f"8000{index}", name=f"Proveedor {index}"),
+    )
+    item = ReceiptItem.objects.create(
+        receipt=receipt,
+        object_of_expenditure=AccountObject.objects.create(
+            key=index, value=f"Objeto {index}"
+        ),
+        unit_price=400,
+        quantity=2,
+    )
+    return {
+        "institution": institution,
+        "disbursement": disbursement,
+        "report": report,
+        "receipt": receipt,
+        "item": item,
+    }
+
+
+class QueryCountTestCase(TestCase):
+    """Starts with an empty aggregate cache and counts the queries of requests"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def fetch(self, url: str, params=None, **headers) -> tuple[bytes, int]:
+        """GETs the url and returns the body and the number of queries run"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params or {}, headers=headers)
+            content = (
+                b"".join(response.streaming_content)
+                if response.streaming
+                else response.content
+            )
+        self.assertEqual(response.status_code, 200, content[:200])
+        return content, len(queries)
+
+    def fetch_json(self, url: str, params=None) -> tuple[dict, int]:
+        content, query_count = self.fetch(url, params)
+        return json.loads(content), query_count
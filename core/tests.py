@@ -1,3 +1,524 @@
+import csv
+import io
+import json
+import os
+import pickle
+import pstats
+import tempfile
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError
 from django.test import TestCase
+from django.utils import timezone
+
+from core.models import (
+    Department,
+    District,
+    Establishment,
+    ImportCheckpoint,
+    ImportFingerprint,
+    ImportJob,
+    Institution,
+    Locality,
+)
+from core.jobs import (
+    PROGRESS_INTERVAL,
+    STALE_JOB_INTERVALS,
+    ProgressReporter,
+    claim_next_job,
+    run_job,
+)
+from core.processors import (
+    BulkDataImporter,
+    DataImporter,
+    PartitionImporter,
+    import_in_parallel,
+    partition_by_department,
+)
+from core.testing import QueryCountTestCase, create_institution_data
+
+
+class InstitutionSummaryTestCase(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = [create_institution_data(index) for index in range(1, 4)]
+
+    def summary(self, params=None):
+        data, query_count = self.fetch_json("/api/institutions/", params)
+        return data["summary"], query_count
+
+    def test_summary_totals(self):
+        self.assertEqual(self.summary()[0], {"disbursed": 3000, "reported": 2400.0})
+        self.assertEqual(
+            self.summary({"name": "Escuela 2"})[0],
+            {"disbursed": 1000, "reported": 800.0},
+        )
+
+    def test_summary_is_cached_until_a_disbursement_changes(self):
+        _, uncached_count = self.summary()
+        # pagination parameters share the cached summary
+        self.assertEqual(
+            self.summary({"limit": 1})[0], {"disbursed": 3000, "reported": 2400.0}
+        )
+        summary, cached_count = self.summary()
+        self.assertEqual(summary, {"disbursed": 3000, "reported": 2400.0})
+        self.assertEqual(cached_count, uncached_count - 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            disbursement = self.data[0]["disbursement"]
+            disbursement.amount_disbursed = 500
+            disbursement.save()
+        self.assertEqual(self.summary()[0], {"disbursed": 2500, "reported": 2400.0})
+
+    def test_summary_is_invalidated_by_moving_a_locality(self):
+        department = self.data[0]["institution"].establishment.district.department
+        self.assertEqual(
+            self.summary({"department": department.pk})[0],
+            {"disbursed": 1000, "reported": 800.0},
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            locality = self.data[1]["institution"].establishment.locality
+            locality.district = self.data[0]["institution"].establishment.district
+            locality.code = "2"
+            locality.save()
+        self.assertEqual(
+            self.summary({"department": department.pk})[0],
+            {"disbursed": 2000, "reported": 1600.0},
+        )
+
+
+class Stream(io.StringIO):
+    """A text stream that cannot be rewound, like a pipe"""
+
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation("seek")
+
+
+class SerialExecutor:
+    """
+    Runs the submitted calls in the current process, which shares the test
+    database, pickling arguments and results as a process pool would
+    """
+
+    def __init__(self, max_workers, initializer):
+        self.max_workers = max_workers
+        initializer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, function, *args):
+        future = Future()
+        result = function(*pickle.loads(pickle.dumps(args)))
+        future.set_result(pickle.loads(pickle.dumps(result)))
+        return future
+
+
+class ImporterTestCase(TestCase):
+    HEADERS = [
+        "codigo_departamento",
+        "nombre_departamento",
+        "codigo_distrito",
+        "nombre_distrito",
+        "codigo_barrio_localidad",
+        "nombre_barrio_localidad",
+        "codigo_establecimiento",
+        "anio",
+        "direccion",
+        "latitud",
+        "longitud",
+        "codigo_institucion",
+        "nombre_institucion",
+        "sector_o_tipo_gestion",
+        "nro_telefono",
+    ]
+
+    @staticmethod
+    def row(index: int, **values) -> dict:
+        return {
+            "codigo_departamento": "1",
+            "nombre_departamento": "CONCEPCION",
+            "codigo_distrito": "2",
+            "nombre_distrito": "BELEN",
+            "codigo_barrio_localidad": "3",
+            "nombre_barrio_localidad": "CENTRO",
+            "codigo_establecimiento": f"E{index}",
+            "anio": "2023",
+            "direccion": f"Calle {index}",
+            "latitud": "",
+            "longitud": "",
+            "codigo_institucion": str(index),
+            "nombre_institucion": f"ESCUELA {index}",
+            "sector_o_tipo_gestion": "OFICIAL",
+            "nro_telefono": "",
+            **values,
+        }
+
+    @classmethod
+    def csv_file(cls, rows, extra=None) -> io.StringIO:
+        """
+        Writes the rows with the importer headers; ``extra`` maps row
+        positions to cells written past the last header
+        """
+        file = io.StringIO()
+        writer = csv.writer(file)
+        writer.writerow(cls.HEADERS)
+        for position, row in enumerate(rows):
+            cells = [row[header] for header in cls.HEADERS]
+            writer.writerow(cells + (extra or {}).get(position, []))
+        file.seek(0)
+        return file
+
+    def bulk_import(self, rows, **kwargs) -> BulkDataImporter:
+        importer = BulkDataImporter(
+            self.csv_file(rows, kwargs.pop("extra", None)), "institutions", **kwargs
+        )
+        importer.process()
+        return importer
+
+    def test_rows_with_cells_past_the_headers(self):
+        rows = [self.row(1), self.row(2)]
+        importer = self.bulk_import(rows, extra={1: ["sobrante", "otro"]})
+        self.assertEqual(importer.skipped_rows, [])
+        self.assertEqual(importer.counts["inserted"], 2)
+        importer = self.bulk_import(rows, extra={1: ["distinto"]})
+        self.assertEqual(importer.counts["unchanged"], 2)
+
+    def test_deleted_rows_are_imported_again(self):
+        rows = [self.row(1), self.row(2)]
+        self.bulk_import(rows)
+        Institution.objects.filter(code=2).delete()
+        importer = self.bulk_import(rows)
+        self.assertEqual(importer.counts, {"inserted": 1, "updated": 0, "unchanged": 1})
+        self.assertTrue(Institution.objects.filter(code=2).exists())
+
+    def test_row_engine_forgets_fingerprints(self):
+        rows = [self.row(1), self.row(2)]
+        self.bulk_import(rows)
+        DataImporter(
+            self.csv_file([self.row(2, nro_telefono="021 555")]), "institutions"
+        ).process()
+        # only the fingerprint of the row written by the row engine is gone
+        self.assertEqual(
+            list(ImportFingerprint.objects.values_list("key", flat=True)),
+            ["E1-1-ESCUELA 1"],
+        )
+        # the bulk importer writes that row again instead of trusting a stale
+        # fingerprint
+        importer = self.bulk_import(rows)
+        self.assertEqual(importer.counts, {"inserted": 0, "updated": 1, "unchanged": 1})
+        self.assertEqual(Institution.objects.get(code=2).phone_number, "")
+
+    def test_import_from_stdin(self):
+        stdin = Stream(self.csv_file([self.row(1), self.row(2)]).getvalue())
+        with mock.patch("sys.stdin", stdin):
+            call_command("importdata", "institutions", "-", stdout=io.StringIO())
+        self.assertEqual(Institution.objects.count(), 2)
+        self.assertFalse(ImportCheckpoint.objects.exists())
+        with mock.patch("sys.stdin", Stream("")), self.assertRaises(CommandError):
+            call_command("importdata", "institutions", "-", "--resume")
+
+    def test_partitions_with_cells_past_the_headers(self):
+        file = self.csv_file([self.row(1), self.row(2)], extra={0: ["sobrante"]})
+        (rows,) = partition_by_department(file).values()
+        importer = PartitionImporter(rows, "institutions")
+        self.assertEqual(importer.process(), [])
+        self.assertEqual(importer.counts["inserted"], 2)
+
+    def import_file(self, rows, *args) -> str:
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as file:
+            file.write(self.csv_file(rows).getvalue())
+        self.addCleanup(os.remove, file.name)
+        stdout = io.StringIO()
+        call_command("importdata", "institutions", file.name, *args, stdout=stdout)
+        return stdout.getvalue()
+
+    @staticmethod
+    def stored_data():
+        return {
+            model._meta.label: sorted(
+                model.objects.values_list(*fields), key=lambda row: repr(row)
+            )
+            for model, fields in (
+                (Department, ("code", "name")),
+                (District, ("department__code", "code", "name")),
+                (Locality, ("district__code", "code", "name")),
+                (
+                    Establishment,
+                    (
+                        "code",
+                        "district__code",
+                        "locality__code",
+                        "address",
+                        "latitude",
+                        "longitude",
+                        "last_data_capture",
+                    ),
+                ),
+                (
+                    Institution,
+                    (
+                        "establishment__code",
+                        "code",
+                        "name",
+                        "institution_type",
+                        "phone_number",
+                    ),
+                ),
+            )
+        }
+
+    def sample_rows(self):
+        return [
+            self.row(1, latitud="25º 17' 3\" S", longitud="57º 38' 6\" W"),
+            # a second institution of the same establishment
+            self.row(1, codigo_institucion="1.002", nombre_institucion="COLEGIO 1"),
+            self.row(2, codigo_distrito="5", codigo_barrio_localidad="7"),
+            self.row(3, codigo_departamento=""),
+            self.row(4, codigo_institucion="abc"),
+        ]
+
+    def test_bulk_and_row_engines_store_the_same_data(self):
+        rows = self.sample_rows()
+        row_skipped = DataImporter(self.csv_file(rows), "institutions").process()
+        row_data = self.stored_data()
+        for model in (Institution, Establishment, Locality, District, Department):
+            model.objects.all().delete()
+        bulk_skipped = self.bulk_import(rows, batch_size=2).skipped_rows
+        self.assertEqual(self.stored_data(), row_data)
+        self.assertEqual(sorted(bulk_skipped), sorted(row_skipped))
+        self.assertEqual(len(row_data["core.Institution"]), 3)
+        self.assertIsNotNone(Establishment.objects.get(code="E1").latitude)
+        self.assertEqual([line for line, _ in sorted(bulk_skipped)], [5, 6])
+
+    def test_rerun_counts_only_changed_rows(self):
+        rows = [self.row(index) for index in range(1, 5)]
+        importer = self.bulk_import(rows)
+        self.assertEqual(importer.counts, {"inserted": 4, "updated": 0, "unchanged": 0})
+        importer = self.bulk_import(rows)
+        self.assertEqual(importer.counts, {"inserted": 0, "updated": 0, "unchanged": 4})
+        rows[2] = self.row(3, nro_telefono="021 555")
+        importer = self.bulk_import(rows)
+        self.assertEqual(importer.counts, {"inserted": 0, "updated": 1, "unchanged": 3})
+        self.assertEqual(Institution.objects.get(code=3).phone_number, "021 555")
+
+    def test_resume_after_a_failed_batch(self):
+        rows = [self.row(index) for index in range(1, 5)]
+        write_institutions = BulkDataImporter._write_institutions
+        calls = []
+
+        def failing_write(importer, batch_rows):
+            calls.append(batch_rows)
+            if len(calls) == 2:
+                raise DatabaseError("conexión perdida")
+            return write_institutions(importer, batch_rows)
+
+        with mock.patch.object(
+            BulkDataImporter, "_write_institutions", failing_write
+        ), self.assertRaises(DatabaseError):
+            self.import_file(rows, "--batch-size", "2")
+        # the first batch was committed with its checkpoint
+        self.assertEqual(Institution.objects.count(), 2)
+        self.assertEqual(ImportCheckpoint.objects.get().last_row, 2)
+        output = self.import_file(rows, "--batch-size", "2", "--resume")
+        self.assertIn("Resuming after line 3", output)
+        self.assertIn("Inserted: 2. Updated: 0. Unchanged: 0.", output)
+        self.assertEqual(Institution.objects.count(), 4)
+        self.assertTrue(ImportCheckpoint.objects.get().finished)
+        self.assertIn("File was already imported", self.import_file(rows, "--resume"))
+
+    def parallel_rows(self):
+        return self.sample_rows() + [
+            self.row(5, codigo_departamento="2", nombre_departamento="SAN PEDRO"),
+            self.row(6, codigo_departamento="2", nombre_departamento="SAN PEDRO"),
+            self.row(7, codigo_departamento="3", codigo_distrito="5"),
+            self.row(8, codigo_departamento="3", nro_telefono="021 555"),
+        ]
+
+    # the workers share the test connection, which must stay open
+    @mock.patch("core.processors.connections.close_all")
+    @mock.patch("core.processors.ProcessPoolExecutor", SerialExecutor)
+    def test_parallel_and_bulk_imports_store_the_same_data(self, close_all):
+        rows = self.parallel_rows()
+        importer = self.bulk_import(rows, batch_size=2)
+        bulk_data = self.stored_data()
+        for model in (
+            Institution,
+            Establishment,
+            Locality,
+            District,
+            Department,
+            ImportFingerprint,
+        ):
+            model.objects.all().delete()
+        output = self.import_file(rows, "--workers", "2", "--batch-size", "2")
+        self.assertEqual(self.stored_data(), bulk_data)
+        self.assertEqual(len(bulk_data["core.Department"]), 3)
+        self.assertEqual(importer.counts, {"inserted": 7, "updated": 0, "unchanged": 0})
+        self.assertIn("Inserted: 7. Updated: 0. Unchanged: 0.", output)
+        rows_processed, skipped, counts, stats = import_in_parallel(
+            self.csv_file(rows), "institutions", 2, batch_size=2
+        )
+        self.assertEqual(rows_processed, importer.rows_processed)
+        self.assertEqual(skipped, sorted(importer.skipped_rows))
+        self.assertEqual(counts, {"inserted": 0, "updated": 0, "unchanged": 7})
+        self.assertEqual(stats.caches["fingerprints"]["hits"], 7)
+
+    @staticmethod
+    def stats_of(output: str) -> dict:
+        (line,) = (line for line in output.splitlines() if line.startswith("{"))
+        return json.loads(line)
+
+    def test_stats_and_profile(self):
+        rows = [self.row(index) for index in range(1, 6)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "import.prof")
+            output = self.import_file(rows, "--batch-size", "2", "--profile", path)
+            self.assertIn(f"Profile written to {path}", output)
+            profile = pstats.Stats(path)
+        functions = {function for _, _, function in profile.stats}
+        self.assertIn("_write_institutions", functions)
+        stats = self.stats_of(output)
+        self.assertGreater(stats["queries"], 0)
+        for stage in ("parse", "fingerprint", "validate", "write_institutions"):
+            self.assertGreaterEqual(stats["stages"][stage]["seconds"], 0)
+        self.assertEqual(stats["stages"]["parse"]["calls"], 6)
+        self.assertEqual(stats["stages"]["write_institutions"]["calls"], 3)
+        self.assertEqual(
+            stats["caches"]["fingerprints"], {"hits": 0, "misses": 5, "hit_rate": 0}
+        )
+        rows[0] = self.row(1, nro_telefono="021 555")
+        stats = self.stats_of(self.import_file(rows, "--batch-size", "2"))
+        self.assertEqual(
+            stats["caches"]["fingerprints"], {"hits": 4, "misses": 1, "hit_rate": 0.8}
+        )
+
+    def test_dry_run_writes_nothing(self):
+        output = self.import_file(self.sample_rows(), "--dry-run")
+        self.assertIn("Inserted: 3. Updated: 0. Unchanged: 0.", output)
+        for model in (
+            Department,
+            Establishment,
+            Institution,
+            ImportCheckpoint,
+            ImportFingerprint,
+        ):
+            self.assertFalse(model.objects.exists(), model._meta.label)
+
+
+class ImportJobTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = self.settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def create_job(self, kind="institutions", content=None, **fields):
+        if content is None:
+            rows = [ImporterTestCase.row(1), ImporterTestCase.row(2)]
+            content = ImporterTestCase.csv_file(rows).getvalue()
+        return ImportJob.objects.create(
+            kind=kind, file=ContentFile(content.encode(), name="datos.csv"), **fields
+        )
+
+    def test_claims_the_oldest_pending_job_skipping_locked_rows(self):
+        first, second = self.create_job(), self.create_job()
+        running = self.create_job(status=ImportJob.Status.running)
+        with mock.patch.object(
+            ImportJob.objects,
+            "select_for_update",
+            wraps=ImportJob.objects.select_for_update,
+        ) as select_for_update:
+            claimed = claim_next_job()
+        select_for_update.assert_called_once_with(skip_locked=True)
+        self.assertEqual(claimed, first)
+        first.refresh_from_db()
+        self.assertEqual(first.status, ImportJob.Status.running)
+        self.assertIsNotNone(first.started_at)
+        self.assertEqual(claim_next_job(), second)
+        self.assertIsNone(claim_next_job())
+        running.refresh_from_db()
+        self.assertEqual(running.status, ImportJob.Status.running)
+
+    def test_abandoned_running_jobs_are_failed(self):
+        abandoned = self.create_job(status=ImportJob.Status.running)
+        active = self.create_job(status=ImportJob.Status.running)
+        stale_before = timezone.now() - timedelta(
+            seconds=PROGRESS_INTERVAL * STALE_JOB_INTERVALS + 1
+        )
+        ImportJob.objects.filter(pk=abandoned.pk).update(updated_at=stale_before)
+        self.assertIsNone(claim_next_job())
+        abandoned.refresh_from_db()
+        active.refresh_from_db()
+        self.assertEqual(abandoned.status, ImportJob.Status.failed)
+        self.assertIn("interrumpió", abandoned.error)
+        self.assertIsNotNone(abandoned.finished_at)
+        self.assertEqual(active.status, ImportJob.Status.running)
+
+    def test_successful_run(self):
+        self.create_job()
+        job = run_job(claim_next_job())
+        self.assertEqual(job.status, ImportJob.Status.finished)
+        self.assertEqual((job.rows_done, job.rows_skipped), (2, 0))
+        self.assertEqual(job.skipped_rows, [])
+        self.assertIn("write_institutions", job.stats["stages"])
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(Institution.objects.count(), 2)
+
+    def test_failed_run(self):
+        job = run_job(self.create_job(kind="reports", content="no es un Excel"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.failed)
+        self.assertIn("Traceback", job.error)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_progress_is_saved_at_most_once_per_interval(self):
+        job = self.create_job(status=ImportJob.Status.running)
+        with mock.patch("core.jobs.time.monotonic", side_effect=[10.0, 10.5, 11.5]):
+            progress = ProgressReporter(job, interval=1.0)
+            progress(100, 1)
+            progress(200, 2)
+            job.refresh_from_db()
+            self.assertEqual((job.rows_done, job.rows_skipped), (100, 1))
+            progress(300, 3)
+        job.refresh_from_db()
+        self.assertEqual((job.rows_done, job.rows_skipped), (300, 3))
+
+    def test_runworker_processes_the_queue(self):
+        jobs = [self.create_job(), self.create_job(kind="reports", content="x")]
+        stdout = io.StringIO()
+        call_command("runworker", "--once", stdout=stdout)
+        statuses = [ImportJob.objects.get(pk=job.pk).status for job in jobs]
+        self.assertEqual(statuses, [ImportJob.Status.finished, ImportJob.Status.failed])
+        self.assertIn(
+            f"Job {jobs[0].pk} Finalizado: 2 rows, 0 skipped", stdout.getvalue()
+        )
 
-# Create your tests here.
+    def test_admin_queues_jobs(self):
+        user = get_user_model().objects.create_superuser(
+            email="admin@example.com", password="secreto"
+        )
+        self.client.force_login(user)
+        file = ContentFile(b"codigo_establecimiento\n", name="datos.csv")
+        response = self.client.post(
+            "/admin/core/importjob/add/", {"kind": "institutions", "file": file}
+        )
+        self.assertEqual(response.status_code, 302)
+        job = ImportJob.objects.get()
+        self.assertEqual((job.status, job.created_by), (ImportJob.Status.pending, user))
+        response = self.client.get(f"/admin/core/importjob/{job.pk}/change/")
+        self.assertContains(response, 'http-equiv="refresh"')
+        ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.Status.finished)
+        response = self.client.get(f"/admin/core/importjob/{job.pk}/change/")
+        self.assertNotContains(response, 'http-equiv="refresh"')
@@ -1,9 +1,10 @@
-from django.db.models import Sum
+from django.db.models import F, FloatField, OuterRef, Subquery, Sum
 from rest_framework import viewsets
 
-from accountability.models import Receipt, Disbursement
+from accountability.models import Receipt, ReceiptItem, Disbursement
+from core.cache import cached_aggregate
 from core.filters import InstitutionFilter
-from core.models import Institution, Department, District
+from core.models import Institution, Department, District, Establishment, Locality
 from core.serializers import (
     InstitutionSerializer,
     DepartmentSerializer,
@@ -23,18 +24,52 @@ class InstitutionViewSet(viewsets.ReadOnlyModelViewSet):
         return response
 
     def get_totals(self):
-        qs = self.filter_queryset(self.get_queryset())
-        receipts = Receipt.objects.filter(institution__in=qs).distinct()
-        disbursements = Disbursement.objects.filter(institution__in=qs).distinct()
-        total_reported = receipts.aggregate(total_reported=Sum("receipt_total"))[
-            "total_reported"
-        ]
-        total_disbursed = disbursements.aggregate(
-            total_disbursed=Sum("amount_disbursed")
-        )["total_disbursed"]
+        # the district and department filters go through the establishment's
+        # locality, so moving a locality or district changes the totals
+        return cached_aggregate(
+            "institution-summary",
+            [
+                Institution,
+                Establishment,
+                Locality,
+                District,
+                Department,
+                Disbursement,
+                Receipt,
+                ReceiptItem,
+            ],
+            self.request.query_params,
+            self.compute_totals,
+        )
+
+    def compute_totals(self):
+        """
+        Sums the disbursed and reported amounts of the filtered institutions in
+        a single query, with one correlated subquery per institution and amount
+        """
+        ids = self.filter_queryset(self.get_queryset()).values("pk")
+        disbursed = (
+            Disbursement.objects.filter(institution=OuterRef("pk"))
+            .values("institution")
+            .annotate(total=Sum("amount_disbursed"))
+            .values("total")
+        )
+        reported = (
+            ReceiptItem.objects.filter(receipt__institution=OuterRef("pk"))
+            .values("receipt__institution")
+            .annotate(
+                total=Sum(F("unit_price") * F("quantity"), output_field=FloatField())
+            )
+            .values("total")
+        )
+        totals = (
+            Institution.objects.filter(pk__in=ids)
+            .annotate(disbursed=Subquery(disbursed), reported=Subquery(reported))
+            .aggregate(total_disbursed=Sum("disbursed"), total_reported=Sum("reported"))
+        )
         return {
-            "disbursed": total_disbursed,
-            "reported": total_reported,
+            "disbursed": totals["total_disbursed"],
+            "reported": totals["total_reported"],
         }
 
 
@@ -98,6 +98,20 @@ IS_TEST = "pytest" in sys.argv[0]
 
 DATABASES = {"default": TEST_DATABASE if IS_TEST else DEFAULT_DATABASE}
 
+# cached aggregates must be shared by all workers; their table is created with
+# ``manage.py createcachetable``
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "aggregates": (
+        {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+        if IS_TEST
+        else {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "aggregate_cache",
+        }
+    ),
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -282,6 +296,12 @@ UNFOLD = {
             {
                 "title": "Administración",
                 "items": [
+                    {
+                        "title": "Importaciones",
+                        "icon": "upload_file",
+                        "link": reverse_lazy("admin:core_importjob_changelist"),
+                        "permission": lambda request: request.user.is_superuser,
+                    },
                     {
                         "title": "Recursos",
                         "icon": "article",
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import tempfile
+import zipfile
+from datetime import datetime
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.http import QueryDict
+from django.utils import timezone
+
+from website.exports import iter_csv
+from website.snapshots import bundle_name, list_bundles
+from website.views import CSV_SETTINGS, export_rows
+
+logger = logging.getLogger(__name__)
+
+# bundles kept in storage besides the latest one
+KEEP_BUNDLES = 1
+
+
+def _count(rows, counter: dict):
+    for row in rows:
+        counter["rows"] += 1
+        yield row
+
+
+def write_bundle(archive: zipfile.ZipFile, generated_at: datetime) -> dict:
+    """
+    Writes the unfiltered CSV export of every collection to the archive and
+    returns the manifest. The caller provides the transaction.
+    """
+    manifest = {"generated_at": generated_at.isoformat(), "collections": {}}
+    date_time = timezone.localtime(generated_at).timetuple()[:6]
+    for collection, collection_settings in CSV_SETTINGS.items():
+        filename = collection_settings["filename"]
+        counter = {"rows": 0}
+        digest = hashlib.sha256()
+        size = 0
+        rows = _count(export_rows(collection, QueryDict()), counter)
+        info = zipfile.ZipInfo(filename, date_time=date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with archive.open(info, "w", force_zip64=True) as entry:
+            for chunk in iter_csv(collection_settings["headers"], rows):
+                entry.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        manifest["collections"][collection] = {
+            "file": filename,
+            "rows": counter["rows"],
+            "bytes": size,
+            "sha256": digest.hexdigest(),
+        }
+    archive.writestr(
+        zipfile.ZipInfo("manifest.json", date_time=date_time),
+        json.dumps(manifest, indent=2, ensure_ascii=False),
+    )
+    return manifest
+
+
+def build_bundle() -> tuple[str, dict]:
+    """
+    Exports all the collections from a single database snapshot into a ZIP
+    file with a manifest of row counts and checksums, saves it to storage and
+    removes older bundles.
+    """
+    generated_at = timezone.now()
+    with tempfile.TemporaryFile() as tmp:
+        # the isolation level can only be set when starting the transaction
+        outermost = not connection.in_atomic_block
+        with transaction.atomic():
+            if connection.vendor == "postgresql" and outermost:
+                # every export query sees the data as of the first one
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"
+                    )
+            with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                manifest = write_bundle(archive, generated_at)
+        tmp.seek(0)
+        name = default_storage.save(bundle_name(generated_at), File(tmp))
+    for stale in list_bundles()[: -(KEEP_BUNDLES + 1)]:
+        default_storage.delete(stale)
+    logger.info(f"Saved open data bundle {name}")
+    return name, manifest
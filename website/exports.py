@@ -0,0 +1,273 @@
+import csv
+import tempfile
+import zlib
+from decimal import Decimal
+from itertools import chain
+from typing import Iterable, Iterator
+
+import orjson
+from django.db.models import QuerySet
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is only offered when installed
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # parquet exports are only offered when installed
+    pyarrow = None
+
+# rows fetched per round trip from the server-side cursor
+EXPORT_CHUNK_SIZE = 2000
+# bytes buffered before a chunk is sent to the client
+STREAM_BUFFER_SIZE = 64 * 1024
+# rows per worksheet allowed by Excel, including the header
+XLSX_MAX_ROWS = 1_048_576
+# rows per parquet row group, buffered in memory before being written
+PARQUET_ROW_GROUP_SIZE = 50_000
+
+
+class Echo:
+    """File-like object whose ``write`` returns the value instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def iter_queryset(queryset: QuerySet, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Iterates a queryset without filling its result cache. On PostgreSQL rows
+    are read through a server-side cursor, ``chunk_size`` at a time.
+    """
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def iter_keyset(queryset: QuerySet, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Iterates a queryset in primary key order, one ``pk > last ORDER BY pk
+    LIMIT chunk_size`` query per chunk, so that the database never sorts or
+    aggregates the whole result before returning the first rows.
+    """
+    queryset = queryset.order_by("pk")
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        objs = list(chunk[:chunk_size])
+        yield from objs
+        if len(objs) < chunk_size:
+            return
+        last_pk = objs[-1].pk
+
+
+def buffered(
+    chunks: Iterable[bytes], size: int = STREAM_BUFFER_SIZE
+) -> Iterator[bytes]:
+    """Joins small chunks into blocks of about ``size`` bytes"""
+    buffer = []
+    buffer_size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffer_size += len(chunk)
+        if buffer_size >= size:
+            yield b"".join(buffer)
+            buffer = []
+            buffer_size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def iter_csv(headers: list[str], rows: Iterable[list]) -> Iterator[bytes]:
+    writer = csv.writer(Echo())
+    lines = chain([writer.writerow(headers)], (writer.writerow(row) for row in rows))
+    return buffered(line.encode() for line in lines)
+
+
+def _json_default(value):
+    # same representation as DjangoJSONEncoder
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError
+
+
+def _dump_objects(headers: list[str], rows: Iterable[list], option=None):
+    for row in rows:
+        yield orjson.dumps(
+            dict(zip(headers, row)), default=_json_default, option=option
+        )
+
+
+def iter_json(headers: list[str], rows: Iterable[list]) -> Iterator[bytes]:
+    """Serializes the rows as a JSON array of objects keyed by header"""
+
+    def chunks():
+        yield b"["
+        separator = b""
+        for obj in _dump_objects(headers, rows):
+            yield separator + obj
+            separator = b","
+        yield b"]"
+
+    return buffered(chunks())
+
+
+def iter_ndjson(headers: list[str], rows: Iterable[list]) -> Iterator[bytes]:
+    """Serializes the rows as one JSON object per line"""
+    return buffered(_dump_objects(headers, rows, option=orjson.OPT_APPEND_NEWLINE))
+
+
+def _xlsx_value(value):
+    # control characters are not allowed in worksheet XML
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub("", value)
+    return value
+
+
+def iter_xlsx(
+    headers: list[str], rows: Iterable[list], title: str = "Datos"
+) -> Iterator[bytes]:
+    """
+    Writes the rows to a write-only workbook, which keeps only the current
+    row in memory, saves it to a temporary file and streams the file. Rows
+    beyond the Excel limit continue on additional sheets.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = XLSX_MAX_ROWS
+    for row in rows:
+        if sheet_rows >= XLSX_MAX_ROWS:
+            sheet = workbook.create_sheet(
+                title if sheet is None else f"{title} {len(workbook.worksheets) + 1}"
+            )
+            sheet.append(headers)
+            sheet_rows = 1
+        sheet.append([_xlsx_value(value) for value in row])
+        sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet(title).append(headers)
+    with tempfile.TemporaryFile() as tmp:
+        workbook.save(tmp)
+        tmp.seek(0)
+        while block := tmp.read(STREAM_BUFFER_SIZE):
+            yield block
+
+
+def _parquet_type(name: str):
+    return {
+        "int": pyarrow.int64(),
+        "float": pyarrow.float64(),
+        "date": pyarrow.date32(),
+        # same precision as the coordinate fields
+        "decimal": pyarrow.decimal128(12, 8),
+    }.get(name, pyarrow.string())
+
+
+def _parquet_value(value, type_name: str):
+    if value is None:
+        return None
+    if type_name == "string":
+        return str(value)
+    if value == "":
+        return None
+    if type_name == "int":
+        return round(value)
+    return value
+
+
+def iter_parquet(
+    headers: list[str], rows: Iterable[list], types: dict[str, str] | None = None
+) -> Iterator[bytes]:
+    """
+    Writes the rows to a parquet file, one row group every
+    ``PARQUET_ROW_GROUP_SIZE`` rows, and streams the file. ``types`` maps
+    headers to "int", "float", "date" or "decimal"; other columns are strings.
+    """
+    type_names = [(types or {}).get(header, "string") for header in headers]
+    schema = pyarrow.schema(
+        [
+            (header, _parquet_type(type_name))
+            for header, type_name in zip(headers, type_names)
+        ]
+    )
+    with tempfile.TemporaryFile() as tmp:
+        with pyarrow.parquet.ParquetWriter(tmp, schema, compression="zstd") as writer:
+            columns = [[] for _ in headers]
+            row_groups = 0
+            for row in rows:
+                for column, value, type_name in zip(columns, row, type_names):
+                    column.append(_parquet_value(value, type_name))
+                if len(columns[0]) >= PARQUET_ROW_GROUP_SIZE:
+                    writer.write_table(pyarrow.table(columns, schema=schema))
+                    columns = [[] for _ in headers]
+                    row_groups += 1
+            # an empty export still gets its schema
+            if columns[0] or not row_groups:
+                writer.write_table(pyarrow.table(columns, schema=schema))
+        tmp.seek(0)
+        while block := tmp.read(STREAM_BUFFER_SIZE):
+            yield block
+
+
+def parquet_available() -> bool:
+    return pyarrow is not None
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Compresses the chunks into a gzip stream as they are produced"""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+def zstd_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Compresses the chunks into a zstd frame as they are produced"""
+    compressor = zstandard.ZstdCompressor().compressobj()
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+# name: (compressor, file extension, media type of the compressed file)
+COMPRESSIONS = {
+    "gzip": (gzip_chunks, "gz", "application/gzip"),
+    "zstd": (zstd_chunks, "zst", "application/zstd"),
+}
+
+
+def available_compressions() -> list[str]:
+    """Supported compressions, most preferred first"""
+    return ["zstd", "gzip"] if zstandard else ["gzip"]
+
+
+def accepted_encodings(header: str) -> dict[str, float]:
+    """Parses an ``Accept-Encoding`` header into codings and their q-values"""
+    encodings = {}
+    for item in header.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        encodings[coding.lower()] = quality
+    return encodings
+
+
+def negotiate_compression(encodings: dict[str, float]) -> str | None:
+    """Returns the preferred supported coding accepted by the client, if any"""
+    preferred = available_compressions()
+    accepted = [name for name in preferred if encodings.get(name, 0) > 0]
+    if not accepted:
+        return None
+    return max(accepted, key=lambda name: (encodings[name], -preferred.index(name)))
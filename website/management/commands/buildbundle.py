@@ -0,0 +1,13 @@
+from django.core.management import BaseCommand
+
+from website.bundle import build_bundle
+
+
+class Command(BaseCommand):
+    help = "Builds the ZIP bundle with every open data collection"
+
+    def handle(self, *args, **options):
+        name, manifest = build_bundle()
+        for collection, entry in manifest["collections"].items():
+            self.stdout.write(self.style.SUCCESS(f"{collection}: {entry['rows']} rows"))
+        self.stdout.write(self.style.SUCCESS(f"Saved {name}"))
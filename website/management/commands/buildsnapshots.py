@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from website.views import CSV_SETTINGS, SNAPSHOT_FORMATS, build_snapshot
+
+
+class Command(BaseCommand):
+    help = "Builds the open data export snapshots whose source data changed"
+
+    def handle(self, *args, **options):
+        for collection in CSV_SETTINGS:
+            for _format in SNAPSHOT_FORMATS:
+                snapshot = build_snapshot(collection, _format)
+                if snapshot is None:
+                    self.stdout.write(
+                        self.style.WARNING(
+                            f"{collection}: {_format} is being built elsewhere"
+                        )
+                    )
+                    continue
+                self.stdout.write(self.style.SUCCESS(f"{collection}: {snapshot[0]}"))
@@ -0,0 +1,227 @@
+import gzip
+import hashlib
+import logging
+import re
+import tempfile
+from datetime import datetime, timezone
+from typing import Iterable
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max
+from django.http import HttpResponse, QueryDict, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from core.cache import cached_aggregate, generations
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = "open-data"
+BUNDLE_PREFIX = "datos-abiertos-"
+READ_BLOCK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def snapshot_stamp(sources: Iterable) -> tuple[str, datetime | None]:
+    """
+    Returns a digest identifying the current content of the source models
+    and their latest modification date, cached until any of them changes so
+    that downloads do not scan the source tables.
+    """
+    sources = list(sources)
+    labels = ",".join(model._meta.label_lower for model in sources)
+    name = hashlib.sha256(labels.encode()).hexdigest()[:16]
+    return cached_aggregate(
+        f"snapshot-stamp:{name}",
+        sources,
+        QueryDict(),
+        lambda: _compute_stamp(sources),
+    )
+
+
+def _compute_stamp(sources: list) -> tuple[str, datetime | None]:
+    """
+    Digests the row counts and highest primary keys of the sources, which
+    reflect insertions and deletions, and their cache generations, which
+    reflect in-place edits of tables without ``updated_at``
+    """
+    digest = hashlib.sha256()
+    last_modified = None
+    for model, generation in zip(sources, generations(sources)):
+        aggregates = {"count": Count("pk"), "last_id": Max("pk")}
+        has_updated_at = any(f.name == "updated_at" for f in model._meta.fields)
+        if has_updated_at:
+            aggregates["updated_at"] = Max("updated_at")
+        values = model._base_manager.aggregate(**aggregates)
+        values["generation"] = generation
+        digest.update(f"{model._meta.label}:{sorted(values.items())}".encode())
+        modified = datetime.fromtimestamp(generation / 1e9, tz=timezone.utc)
+        updated_at = values.get("updated_at")
+        if updated_at and updated_at > modified:
+            modified = updated_at
+        if not last_modified or modified > last_modified:
+            last_modified = modified
+    return digest.hexdigest()[:20], last_modified
+
+
+def snapshot_name(collection: str, _format: str, stamp: str, gzipped=True) -> str:
+    name = f"{SNAPSHOT_DIR}/{collection}.{stamp}.{_format}"
+    return f"{name}.gz" if gzipped else name
+
+
+def write_snapshot(name: str, chunks: Iterable[bytes], gzipped=True):
+    """
+    Writes the chunks into a temporary file, gzip compressed unless the format
+    is already compressed, and saves it to storage
+    """
+    with tempfile.TemporaryFile() as tmp:
+        if gzipped:
+            with gzip.GzipFile(fileobj=tmp, mode="wb") as compressed:
+                for chunk in chunks:
+                    compressed.write(chunk)
+        else:
+            for chunk in chunks:
+                tmp.write(chunk)
+        tmp.seek(0)
+        # a concurrent build may have saved the same snapshot meanwhile
+        if not default_storage.exists(name):
+            default_storage.save(name, File(tmp))
+    logger.info(f"Saved export snapshot {name}")
+
+
+def remove_stale_snapshots(collection: str, _format: str, current: str, gzipped=True):
+    try:
+        _, filenames = default_storage.listdir(SNAPSHOT_DIR)
+    except FileNotFoundError:
+        return
+    suffix = f".{_format}.gz" if gzipped else f".{_format}"
+    for filename in filenames:
+        name = f"{SNAPSHOT_DIR}/{filename}"
+        if (
+            filename.startswith(f"{collection}.")
+            and filename.endswith(suffix)
+            and name != current
+        ):
+            default_storage.delete(name)
+
+
+def bundle_name(generated_at: datetime) -> str:
+    return f"{SNAPSHOT_DIR}/{BUNDLE_PREFIX}{generated_at:%Y%m%d%H%M%S}.zip"
+
+
+def list_bundles() -> list[str]:
+    """Names of the stored bundles, oldest first"""
+    try:
+        _, filenames = default_storage.listdir(SNAPSHOT_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        f"{SNAPSHOT_DIR}/{filename}"
+        for filename in filenames
+        if filename.startswith(BUNDLE_PREFIX) and filename.endswith(".zip")
+    )
+
+
+def latest_bundle() -> dict | None:
+    bundles = list_bundles()
+    if not bundles:
+        return None
+    name = bundles[-1]
+    timestamp = name.removeprefix(f"{SNAPSHOT_DIR}/{BUNDLE_PREFIX}").removesuffix(
+        ".zip"
+    )
+    return {
+        "url": default_storage.url(name),
+        "size": default_storage.size(name),
+        "generated_at": datetime.strptime(timestamp, "%Y%m%d%H%M%S").replace(
+            tzinfo=timezone.utc
+        ),
+    }
+
+
+def _parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parses a single ``bytes`` range into inclusive offsets. Returns None when
+    the header is malformed or asks for several ranges, in which case the
+    whole file is sent, and raises ValueError when it cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if not start:
+        # suffix range: the last ``end`` bytes
+        length = int(end)
+        if not length:
+            raise ValueError
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError
+    return start, end
+
+
+def _read_file(name: str, start: int, length: int):
+    with default_storage.open(name, "rb") as file:
+        file.seek(start)
+        while length > 0:
+            block = file.read(min(READ_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def snapshot_response(
+    request,
+    name: str,
+    content_type: str,
+    stamp: str,
+    last_modified: datetime | None,
+    filename: str | None = None,
+    content_encoding: str | None = "gzip",
+):
+    """
+    Serves a snapshot, by default as a gzip encoded representation of the
+    export, answering conditional requests with 304 and ``Range`` requests
+    with 206. Without ``content_encoding`` the stored file itself is sent.
+    """
+    etag = quote_etag(stamp)
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        size = default_storage.size(name)
+        start, end = 0, size - 1
+        status = 200
+        range_header = request.headers.get("Range")
+        if_range = request.headers.get("If-Range")
+        if range_header and (not if_range or if_range == etag):
+            try:
+                byte_range = _parse_range(range_header, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = f"bytes */{size}"
+                return response
+            if byte_range:
+                start, end = byte_range
+                status = 206
+        response = StreamingHttpResponse(
+            _read_file(name, start, end - start + 1),
+            status=status,
+            content_type=content_type,
+        )
+        response["Content-Length"] = end - start + 1
+        if status == 206:
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        if filename:
+            response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    if content_encoding:
+        response["Content-Encoding"] = content_encoding
+    response["Accept-Ranges"] = "bytes"
+    response["Vary"] = "Accept-Encoding"
+    response["ETag"] = etag
+    if timestamp:
+        response["Last-Modified"] = http_date(timestamp)
+    return response
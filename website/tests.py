@@ -1,3 +1,393 @@
-from django.test import TestCase
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import json
+import tempfile
+import unittest
+import zipfile
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.utils import timezone
+from openpyxl import load_workbook
+
+from accountability.models import Receipt, ReceiptItem
+from core.cache import cache
+from core.testing import QueryCountTestCase, create_institution_data
+from website.exports import (
+    accepted_encodings,
+    available_compressions,
+    iter_keyset,
+    negotiate_compression,
+    parquet_available,
+    zstandard,
+)
+from website.snapshots import (
+    SNAPSHOT_DIR,
+    bundle_name,
+    latest_bundle,
+    list_bundles,
+    snapshot_stamp,
+)
+from website.views import CSV_SETTINGS, build_snapshot, current_snapshot
+
+
+class ExportQueryCountTestCase(QueryCountTestCase):
+    def export(self, collection: str, _format: str = "csv"):
+        return self.fetch("/export/", {"collection": collection, "format": _format})
+
+    def test_query_count_does_not_depend_on_row_count(self):
+        create_institution_data(1)
+        single_row_counts = {
+            collection: self.export(collection)[1] for collection in CSV_SETTINGS
+        }
+        for index in range(2, 6):
+            create_institution_data(index)
+        for collection in CSV_SETTINGS:
+            with self.subTest(collection=collection):
+                content, query_count = self.export(collection)
+                lines = content.decode().splitlines()
+                self.assertEqual(len(lines), 6)
+                self.assertEqual(
+                    lines[0].split(","), CSV_SETTINGS[collection]["headers"]
+                )
+                self.assertEqual(query_count, single_row_counts[collection])
+        content, _ = self.export("receipts")
+        self.assertEqual(
+            [line.split(",")[-1] for line in content.decode().splitlines()[1:]],
+            ["800.0"] * 5,
+        )
+
+    def test_report_total_annotation(self):
+        create_institution_data(1)
+        content, _ = self.export("reports")
+        header, row = content.decode().splitlines()
+        self.assertEqual(len(header.split(",")), len(row.split(",")))
+        self.assertIn(",800,", row)
+
+    @unittest.skipUnless(parquet_available(), "pyarrow is not installed")
+    def test_parquet_column_types(self):
+        import pyarrow.parquet
+
+        create_institution_data(1)
+        # unfiltered parquet downloads look for a stored snapshot
+        with tempfile.TemporaryDirectory() as media_root:
+            with self.settings(MEDIA_ROOT=media_root):
+                content, _ = self.export("disbursements", "parquet")
+        table = pyarrow.parquet.read_table(io.BytesIO(content))
+        row = table.to_pylist()[0]
+        self.assertEqual(row["fecha_desembolso"], date(2023, 3, 1))
+        self.assertEqual(row["monto_desembolsado"], 1000)
+        self.assertEqual(str(table.schema.field("monto_desembolsado").type), "int64")
+
+
+class SnapshotTestCase(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = create_institution_data(1)
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = self.settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def snapshots(self):
+        if not default_storage.exists(SNAPSHOT_DIR):
+            return []
+        return sorted(default_storage.listdir(SNAPSHOT_DIR)[1])
+
+    def export(self):
+        response = self.client.get(
+            "/export/",
+            {"collection": "receipts", "format": "csv"},
+            headers={"Accept-Encoding": "gzip"},
+        )
+        self.assertEqual(response.status_code, 200)
+        content = b"".join(response.streaming_content)
+        return response, content
+
+    def rename_provider(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            provider = self.data["receipt"].provider
+            provider.name = name
+            provider.save()
+
+    def test_downloads_are_streamed_until_the_snapshot_is_built(self):
+        response, live = self.export()
+        self.assertNotIn("ETag", response)
+        self.assertEqual(self.snapshots(), [])
+        call_command("buildsnapshots", stdout=io.StringIO())
+        self.assertIn("receipts.", " ".join(self.snapshots()))
+        response, stored = self.export()
+        self.assertIn("ETag", response)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(stored), gzip.decompress(live))
+
+    def test_snapshot_is_rebuilt_after_editing_a_source_row(self):
+        first, _, _ = build_snapshot("receipts", "csv")
+        # providers have no ``updated_at``, nor does renaming change the counts
+        self.rename_provider("Proveedor renombrado")
+        self.assertIsNone(current_snapshot("receipts", "csv"))
+        response, content = self.export()
+        self.assertNotIn("ETag", response)
+        self.assertIn(b"Proveedor renombrado", gzip.decompress(content))
+        second, _, _ = build_snapshot("receipts", "csv")
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.snapshots(), [second.removeprefix(f"{SNAPSHOT_DIR}/")])
+
+    def test_stamp_is_cached_until_a_source_changes(self):
+        sources = CSV_SETTINGS["receipts"]["sources"]
+        stamp = snapshot_stamp(sources)
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot_stamp(sources), stamp)
+        self.rename_provider("Proveedor renombrado")
+        self.assertNotEqual(snapshot_stamp(sources)[0], stamp[0])
+
+    def test_build_is_skipped_while_another_one_runs(self):
+        name, _, _ = build_snapshot("receipts", "csv")
+        default_storage.delete(name)
+        cache.add(f"snapshot-lock:{name}", True)
+        self.assertIsNone(build_snapshot("receipts", "csv"))
+        self.assertEqual(self.snapshots(), [])
+
+
+class ExportFormatTestCase(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = [create_institution_data(index) for index in range(1, 4)]
+        establishment = self.data[0]["institution"].establishment
+        establishment.latitude = Decimal("-25.28416667")
+        establishment.longitude = Decimal("-57.63500000")
+        establishment.save()
+
+    def get(self, collection="receipts", _format="csv", headers=None, **params):
+        response = self.client.get(
+            "/export/",
+            {"collection": collection, "format": _format, **params},
+            headers=headers or {},
+        )
+        content = (
+            b"".join(response.streaming_content)
+            if response.streaming
+            else response.content
+        )
+        return response, content
+
+    def download(self, collection, _format="csv", **params):
+        response, content = self.get(collection, _format, **params)
+        self.assertEqual(response.status_code, 200)
+        return content
+
+    def test_json_objects_keyed_by_header(self):
+        headers = CSV_SETTINGS["institutions"]["headers"]
+        objects = json.loads(self.download("institutions", "json"))
+        self.assertEqual([list(obj) for obj in objects], [headers] * 3)
+        first = min(objects, key=lambda obj: obj["id"])
+        self.assertEqual(first["nombre"], "Escuela 1")
+        # decimals keep their digits as strings, as DjangoJSONEncoder does
+        self.assertEqual(first["latitud"], "-25.28416667")
+        self.assertEqual(first["longitud"], "-57.63500000")
+
+    def test_ndjson_has_one_object_per_line(self):
+        content = self.download("institutions", "ndjson")
+        lines = content.decode().splitlines()
+        self.assertTrue(content.endswith(b"\n"))
+        self.assertEqual(len(lines), 3)
+        objects = [json.loads(line) for line in lines]
+        self.assertEqual(objects, json.loads(self.download("institutions", "json")))
+
+    def test_accept_encoding_negotiation(self):
+        self.assertEqual(
+            accepted_encodings("gzip;q=0.5, ZSTD ; q=0.8, br, identity;q=x"),
+            {"gzip": 0.5, "zstd": 0.8, "br": 1.0, "identity": 0.0},
+        )
+        self.assertEqual(negotiate_compression(accepted_encodings("br")), None)
+        self.assertEqual(negotiate_compression(accepted_encodings("gzip;q=0")), None)
+        self.assertEqual(
+            negotiate_compression(accepted_encodings("gzip, zstd;q=0")), "gzip"
+        )
+        expected = "zstd" if "zstd" in available_compressions() else "gzip"
+        self.assertEqual(
+            negotiate_compression(accepted_encodings("gzip, zstd")), expected
+        )
+        self.assertEqual(
+            negotiate_compression(accepted_encodings("gzip;q=0.9, zstd;q=0.5")),
+            "gzip",
+        )
+
+    def test_content_encoding_round_trip(self):
+        plain_response, plain = self.get()
+        self.assertNotIn("Content-Encoding", plain_response)
+        response, content = self.get(headers={"Accept-Encoding": "gzip, zstd;q=0"})
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertEqual(gzip.decompress(content), plain)
+        response, content = self.get(headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(content, plain)
+
+    @unittest.skipUnless(zstandard, "zstandard is not installed")
+    def test_zstd_round_trip(self):
+        _, plain = self.get()
+        response, content = self.get(headers={"Accept-Encoding": "gzip;q=0.5, zstd"})
+        self.assertEqual(response["Content-Encoding"], "zstd")
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self.assertEqual(decompressor.decompress(content), plain)
+        response, content = self.get(compression="zstd")
+        self.assertEqual(response["Content-Type"], "application/zstd")
+        self.assertIn(
+            'filename="comprobantes.csv.zst"', response["Content-Disposition"]
+        )
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self.assertEqual(decompressor.decompress(content), plain)
+
+    def test_compression_parameter(self):
+        _, plain = self.get()
+        response, content = self.get(
+            compression="gzip", headers={"Accept-Encoding": "gzip"}
+        )
+        # the compressed file is the body itself, not a content coding
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertIn('filename="comprobantes.csv.gz"', response["Content-Disposition"])
+        self.assertEqual(gzip.decompress(content), plain)
+        response, content = self.get(compression="brotli")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b"brotli", content)
+
+    def test_keyset_chunks(self):
+        receipt = self.data[0]["receipt"]
+        ReceiptItem.objects.bulk_create(
+            ReceiptItem(receipt=receipt, unit_price=index, description=f"{index}")
+            for index in range(4)
+        )
+        ids = list(ReceiptItem.objects.order_by("pk").values_list("pk", flat=True))
+        self.assertEqual(len(ids), 7)
+        for chunk_size, query_count in ((2, 4), (7, 2), (10, 1)):
+            with self.subTest(chunk_size=chunk_size):
+                queryset = ReceiptItem.objects.order_by("-pk")
+                with self.assertNumQueries(query_count):
+                    items = list(iter_keyset(queryset, chunk_size=chunk_size))
+                self.assertEqual([item.pk for item in items], ids)
+
+    def test_keyset_export_across_chunks(self):
+        for index in range(4, 8):
+            create_institution_data(index)
+        with mock.patch(
+            "website.views.iter_keyset", functools.partial(iter_keyset, chunk_size=3)
+        ):
+            content = self.download("receipts")
+        ids = [int(line.split(",")[0]) for line in content.decode().splitlines()[1:]]
+        self.assertEqual(
+            ids, list(Receipt.objects.order_by("pk").values_list("pk", flat=True))
+        )
+        self.assertEqual(len(ids), 7)
+
+    def test_xlsx_workbook(self):
+        response, content = self.get("receipts", "xlsx")
+        self.assertEqual(response.status_code, 200)
+        sheet = load_workbook(io.BytesIO(content), read_only=True).active
+        rows = list(sheet.values)
+        headers = CSV_SETTINGS["receipts"]["headers"]
+        self.assertEqual(list(rows[0]), headers)
+        self.assertEqual(len(rows), 4)
+        expected = {
+            receipt.pk: receipt for receipt in Receipt.objects.with_total_subquery()
+        }
+        for row in rows[1:]:
+            values = dict(zip(headers, row))
+            receipt = expected.pop(values["id"])
+            self.assertIsInstance(values["id"], int)
+            self.assertIsInstance(values["fecha_comprobante"], datetime)
+            self.assertEqual(values["fecha_comprobante"].date(), receipt.receipt_date)
+            self.assertIsInstance(values["total"], int)
+            self.assertEqual(values["total"], receipt.receipt_total)
+        self.assertEqual(expected, {})
+
+    def test_xlsx_decimals(self):
+        workbook = load_workbook(io.BytesIO(self.download("institutions", "xlsx")))
+        rows = list(workbook.active.values)
+        values = dict(zip(rows[0], rows[1]))
+        self.assertEqual(values["latitud"], -25.28416667)
+        self.assertEqual(values["longitud"], -57.635)
+
+    def test_xlsx_sheets_split_at_limit(self):
+        with mock.patch("website.exports.XLSX_MAX_ROWS", 3):
+            content = self.download("receipts", "xlsx")
+        workbook = load_workbook(io.BytesIO(content))
+        self.assertEqual(workbook.sheetnames, ["Datos", "Datos 2"])
+        first, second = (list(sheet.values) for sheet in workbook.worksheets)
+        self.assertEqual(first[0], second[0])
+        self.assertEqual(len(first) + len(second) - 2, 3)
+
+
+class BundleTestCase(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        for index in range(1, 4):
+            create_institution_data(index)
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = self.settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def build(self, generated_at=None):
+        stdout = io.StringIO()
+        with mock.patch(
+            "website.bundle.timezone.now",
+            return_value=generated_at or timezone.now(),
+        ):
+            call_command("buildbundle", stdout=stdout)
+        return stdout.getvalue()
+
+    def test_manifest_matches_members(self):
+        output = self.build()
+        (name,) = list_bundles()
+        self.assertIn(f"Saved {name}", output)
+        with default_storage.open(name) as file, zipfile.ZipFile(file) as archive:
+            self.assertEqual(
+                sorted(archive.namelist()),
+                sorted(
+                    [settings["filename"] for settings in CSV_SETTINGS.values()]
+                    + ["manifest.json"]
+                ),
+            )
+            manifest = json.loads(archive.read("manifest.json"))
+            members = {
+                collection: archive.read(entry["file"])
+                for collection, entry in manifest["collections"].items()
+            }
+        generated_at = datetime.fromisoformat(manifest["generated_at"])
+        self.assertEqual(
+            latest_bundle()["generated_at"], generated_at.replace(microsecond=0)
+        )
+        self.assertEqual(list(manifest["collections"]), list(CSV_SETTINGS))
+        for collection, entry in manifest["collections"].items():
+            with self.subTest(collection=collection):
+                content = members[collection]
+                rows = list(csv.reader(io.StringIO(content.decode("utf-8-sig"))))
+                self.assertEqual(rows[0], CSV_SETTINGS[collection]["headers"])
+                self.assertEqual(len(rows) - 1, entry["rows"])
+                self.assertGreater(entry["rows"], 0)
+                self.assertEqual(entry["bytes"], len(content))
+                self.assertEqual(entry["sha256"], hashlib.sha256(content).hexdigest())
+                self.assertIn(f"{collection}: {entry['rows']} rows", output)
+                response = self.client.get(
+                    "/export/", {"collection": collection, "format": "csv"}
+                )
+                self.assertEqual(b"".join(response.streaming_content), content)
+
+    def test_older_bundles_are_removed(self):
+        now = timezone.now()
+        for minutes in (30, 20, 10, 0):
+            self.build(now - timedelta(minutes=minutes))
+        self.assertEqual(
+            list_bundles(),
+            [bundle_name(now - timedelta(minutes=10)), bundle_name(now)],
+        )
@@ -1,9 +1,21 @@
-import csv
 import json
 
-from django.db.models import Sum, Q, ExpressionWrapper, F, IntegerField, Value
-from django.db.models.functions import Coalesce, ExtractYear
-from django.http import HttpResponse, JsonResponse
+from django.db.models import (
+    Sum,
+    Q,
+    ExpressionWrapper,
+    F,
+    IntegerField,
+    Value,
+)
+from django.core.files.storage import default_storage
+from django.db.models.functions import Cast, Coalesce, ExtractYear
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    QueryDict,
+    StreamingHttpResponse,
+)
 from django.shortcuts import render, get_object_or_404
 from django.utils import timezone
 from django.views.generic import DetailView, TemplateView
@@ -22,11 +34,45 @@ from accountability.models import (
     DisbursementOrigin,
     ReceiptType,
     AccountObject,
+    Resolution,
+    OriginDetail,
+    PaymentType,
+    Provider,
+    report_total_subquery,
 )
+from core.cache import cache
 from core.filters import InstitutionFilter
-from core.models import Department, Institution, Resource, District
+from core.models import (
+    Department,
+    Institution,
+    Resource,
+    District,
+    Locality,
+    Establishment,
+)
 from core.serializers import InstitutionSerializer
-
+from website.exports import (
+    COMPRESSIONS,
+    accepted_encodings,
+    available_compressions,
+    iter_csv,
+    iter_json,
+    iter_keyset,
+    iter_ndjson,
+    iter_parquet,
+    iter_queryset,
+    iter_xlsx,
+    negotiate_compression,
+    parquet_available,
+)
+from website.snapshots import (
+    latest_bundle,
+    remove_stale_snapshots,
+    snapshot_name,
+    snapshot_response,
+    snapshot_stamp,
+    write_snapshot,
+)
 
 # Create your views here.
 
@@ -51,7 +97,7 @@ def quienes_somos(request):
 
 
 def open_data(request):
-    return render(request, "website/open-data.html")
+    return render(request, "website/open-data.html", {"bundle": latest_bundle()})
 
 
 def institutions_open_data(request):
@@ -189,16 +235,33 @@ class ReportDetailView(TemplateView):
         return context
 
 
-def get_report_total(report):
-    return report.receipts.aggregate(
-        total=Sum("receipt_total", output_field=IntegerField())
-    )["total"]
+def report_total_annotation():
+    """Total of a report's receipt items, as a subquery per report row"""
+    return Cast(report_total_subquery(), IntegerField())
 
 
+# Each collection declares the select_related, prefetch_related and annotate
+# arguments its extractor needs, so that exports run a constant number of
+# queries regardless of the number of rows. Columns listed in types are typed
+# in parquet exports; the rest are strings. Collections marked as keyset are
+# read in primary key chunks; their filters only follow single-valued
+# relations, so they do not need distinct().
 CSV_SETTINGS = {
     "institutions": {
         "queryset": Institution.objects.filter(disbursements__isnull=False).distinct(),
+        "select_related": [
+            "establishment__locality",
+            "establishment__district__department",
+        ],
         "filterset": InstitutionFilter,
+        "sources": [
+            Institution,
+            Establishment,
+            Locality,
+            District,
+            Department,
+            Disbursement,
+        ],
         "filename": "instituciones.csv",
         "headers": [
             "id",
@@ -216,6 +279,7 @@ CSV_SETTINGS = {
             "distrito",
             "departamento",
         ],
+        "types": {"id": "int", "latitud": "decimal", "longitud": "decimal"},
         "extractor": lambda institution: [
             institution.id,
             institution.establishment.code,
@@ -235,7 +299,22 @@ CSV_SETTINGS = {
     },
     "disbursements": {
         "queryset": Disbursement.objects.all(),
+        "select_related": [
+            "resolution",
+            "institution",
+            "funds_origin",
+            "origin_details",
+            "payment_type",
+        ],
         "filterset": DisbursementFilter,
+        "sources": [
+            Disbursement,
+            Resolution,
+            Institution,
+            DisbursementOrigin,
+            OriginDetail,
+            PaymentType,
+        ],
         "filename": "desembolsos.csv",
         "headers": [
             "id",
@@ -253,6 +332,15 @@ CSV_SETTINGS = {
             "tipo_pago",
             "observaciones",
         ],
+        "types": {
+            "id": "int",
+            "id_institucion": "int",
+            "fecha_desembolso": "date",
+            "monto_resolucion": "int",
+            "monto_desembolsado": "int",
+            "origen_fondo": "int",
+            "fecha_a_rendir": "date",
+        },
         "extractor": lambda disbursement: [
             disbursement.id,
             str(disbursement.resolution),
@@ -272,7 +360,10 @@ CSV_SETTINGS = {
     },
     "reports": {
         "queryset": Report.objects.all(),
+        "select_related": ["disbursement__institution"],
+        "annotations": {"total": report_total_annotation()},
         "filterset": ReportFilter,
+        "sources": [Report, Disbursement, Institution, Receipt, ReceiptItem],
         "filename": "rendiciones.csv",
         "headers": [
             "id",
@@ -284,19 +375,30 @@ CSV_SETTINGS = {
             "recepcion",
             "observaciones",
         ],
+        "types": {
+            "id": "int",
+            "id_desembolso": "int",
+            "id_institucion": "int",
+            "fecha_rendicion": "date",
+            "monto_rendido": "int",
+        },
         "extractor": lambda report: [
             report.id,
-            report.disbursement.id,
-            report.disbursement.institution.id,
+            report.disbursement_id,
+            report.disbursement.institution_id,
             report.disbursement.institution.name,
             report.report_date,
-            get_report_total(report),
+            report.total,
             report.delivered_via,
+            report.comments,
         ],
     },
     "receipts": {
-        "queryset": Receipt.objects.all(),
+        "queryset": Receipt.objects.with_total_subquery(),
+        "select_related": ["receipt_type", "provider"],
+        "keyset": True,
         "filterset": ReceiptFilter,
+        "sources": [Receipt, ReceiptType, Provider, ReceiptItem],
         "filename": "comprobantes.csv",
         "headers": [
             "id",
@@ -310,10 +412,18 @@ CSV_SETTINGS = {
             "nombre_proveedor",
             "total",
         ],
+        "types": {
+            "id": "int",
+            "id_institucion": "int",
+            "id_desembolso": "int",
+            "id_rendicion": "int",
+            "fecha_comprobante": "date",
+            "total": "int",
+        },
         "extractor": lambda receipt: [
             receipt.id,
             receipt.institution_id,
-            receipt.disbursement.id,
+            receipt.disbursement_id,
             receipt.report_id,
             receipt.receipt_type.name,
             receipt.receipt_number,
@@ -325,7 +435,10 @@ CSV_SETTINGS = {
     },
     "receipt-items": {
         "queryset": ReceiptItem.objects.all(),
+        "select_related": ["object_of_expenditure"],
+        "keyset": True,
         "filterset": ReceiptItemFilter,
+        "sources": [ReceiptItem, AccountObject],
         "filename": "detalles_de_comprobante.csv",
         "headers": [
             "id",
@@ -335,10 +448,21 @@ CSV_SETTINGS = {
             "concepto",
             "precio_unitario",
         ],
+        "types": {
+            "id": "int",
+            "id_comprobante": "int",
+            "cantidad": "float",
+            "precio_unitario": "int",
+        },
         "extractor": lambda receipt_item: [
             receipt_item.id,
             receipt_item.receipt_id,
-            f"{receipt_item.object_of_expenditure.key}: {receipt_item.object_of_expenditure.value}",
+            (
+                f"{receipt_item.object_of_expenditure.key}: "
+                f"{receipt_item.object_of_expenditure.value}"
+                if receipt_item.object_of_expenditure
+                else ""
+            ),
             receipt_item.quantity,
             receipt_item.description,
             receipt_item.unit_price,
@@ -347,24 +471,126 @@ CSV_SETTINGS = {
 }
 
 
-def add_csv_data(csv_writer, collection, request):
+def get_export_queryset(collection, params):
     collection_settings = CSV_SETTINGS[collection]
     filterset = collection_settings["filterset"](
-        request.GET, queryset=collection_settings["queryset"]
+        params, queryset=collection_settings["queryset"]
     )
-    columns = collection_settings["headers"]
-    csv_writer.writerow(columns)
-    for item in filterset.qs.distinct():
-        csv_writer.writerow(collection_settings["extractor"](item))
+    queryset = filterset.qs
+    if not collection_settings.get("keyset"):
+        queryset = queryset.distinct()
+    if collection_settings.get("select_related"):
+        queryset = queryset.select_related(*collection_settings["select_related"])
+    if collection_settings.get("prefetch_related"):
+        queryset = queryset.prefetch_related(*collection_settings["prefetch_related"])
+    return queryset.annotate(**collection_settings.get("annotations", {}))
+
+
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "text/csv"),
+    "json": (iter_json, "application/json"),
+    "ndjson": (iter_ndjson, "application/x-ndjson"),
+    "xlsx": (
+        iter_xlsx,
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ),
+}
+if parquet_available():
+    EXPORT_FORMATS["parquet"] = (iter_parquet, "application/vnd.apache.parquet")
 
 
-def add_json_data(collection, request):
-    settings = CSV_SETTINGS[collection]
-    filterset = settings["filterset"](request.GET, queryset=settings["queryset"])
-    data = []
-    for item in filterset.qs.all():
-        data.append(dict(zip(settings["headers"], settings["extractor"](item))))
-    return data
+# formats precomputed for unfiltered downloads
+SNAPSHOT_FORMATS = (
+    ("csv", "json", "parquet") if parquet_available() else ("csv", "json")
+)
+# seconds after which the lock of an interrupted snapshot build expires
+SNAPSHOT_LOCK_TIMEOUT = 30 * 60
+# formats that are already compressed and not worth encoding again; their
+# snapshots are stored and served as they are
+COMPRESSED_FORMATS = ("xlsx", "parquet")
+# query parameters that do not filter the exported rows
+EXPORT_PARAMS = ("collection", "format", "compression")
+
+
+def export_rows(collection, params):
+    collection_settings = CSV_SETTINGS[collection]
+    queryset = get_export_queryset(collection, params)
+    items = (
+        iter_keyset(queryset)
+        if collection_settings.get("keyset")
+        else iter_queryset(queryset)
+    )
+    return (collection_settings["extractor"](item) for item in items)
+
+
+def stream_export_data(collection, params, _format):
+    serializer, _ = EXPORT_FORMATS[_format]
+    collection_settings = CSV_SETTINGS[collection]
+    rows = export_rows(collection, params)
+    if _format == "parquet":
+        return serializer(
+            collection_settings["headers"], rows, collection_settings["types"]
+        )
+    return serializer(collection_settings["headers"], rows)
+
+
+def has_filters(params) -> bool:
+    return any(value for key, value in params.items() if key not in EXPORT_PARAMS)
+
+
+def export_filename(collection, _format):
+    return CSV_SETTINGS[collection]["filename"].replace(".csv", f".{_format}")
+
+
+def current_snapshot(collection, _format):
+    """
+    Returns the stored snapshot of the unfiltered export matching the current
+    content of the collection's source tables, or None when it has not been
+    built yet. Snapshots are only written by the ``buildsnapshots`` command.
+    """
+    gzipped = _format not in COMPRESSED_FORMATS
+    stamp, last_modified = snapshot_stamp(CSV_SETTINGS[collection]["sources"])
+    name = snapshot_name(collection, _format, stamp, gzipped)
+    if not default_storage.exists(name):
+        return None
+    return name, stamp, last_modified
+
+
+def build_snapshot(collection, _format):
+    """
+    Writes the snapshot of the unfiltered export when the current one is
+    missing and returns it, or returns None while another process is writing
+    the same snapshot.
+    """
+    gzipped = _format not in COMPRESSED_FORMATS
+    stamp, last_modified = snapshot_stamp(CSV_SETTINGS[collection]["sources"])
+    name = snapshot_name(collection, _format, stamp, gzipped)
+    if not default_storage.exists(name):
+        lock = f"snapshot-lock:{name}"
+        if not cache.add(lock, True, timeout=SNAPSHOT_LOCK_TIMEOUT):
+            return None
+        try:
+            write_snapshot(
+                name, stream_export_data(collection, QueryDict(), _format), gzipped
+            )
+            remove_stale_snapshots(collection, _format, name, gzipped)
+        finally:
+            cache.delete(lock)
+    return name, stamp, last_modified
+
+
+def use_snapshot(params, _format, compression, encodings) -> bool:
+    """
+    Whether the request can be answered with the snapshot: the export is not
+    filtered and the stored file matches the requested compression
+    """
+    if _format not in SNAPSHOT_FORMATS or has_filters(params):
+        return False
+    if _format in COMPRESSED_FORMATS:
+        return not compression
+    if compression:
+        return compression == "gzip"
+    return encodings.get("gzip", 0) > 0
 
 
 def export_to_csv(request):
@@ -372,13 +598,63 @@ def export_to_csv(request):
     _format = request.GET.get("format")
     if not collection:
         return HttpResponse("No collection selected")
-    if _format == "csv":
-        response = HttpResponse(content_type="text/csv")
-        response["Content-Disposition"] = (
-            f'attachment; filename="{CSV_SETTINGS[collection]["filename"]}"'
+    if _format == "parquet" and not parquet_available():
+        return HttpResponseBadRequest("Parquet export is not available")
+    if _format not in EXPORT_FORMATS:
+        _format = "json"
+    _, content_type = EXPORT_FORMATS[_format]
+    filename = export_filename(collection, _format) if _format != "json" else None
+    # an explicit compression produces a compressed file, otherwise the body is
+    # compressed with the best coding accepted by the client
+    compression = request.GET.get("compression")
+    if compression and compression not in available_compressions():
+        return HttpResponseBadRequest(f"Unsupported compression: {compression}")
+    encodings = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+    # until the snapshot of the current data is built, the export is streamed
+    snapshot = (
+        current_snapshot(collection, _format)
+        if use_snapshot(request.GET, _format, compression, encodings)
+        else None
+    )
+    if snapshot:
+        name, stamp, last_modified = snapshot
+        if _format in COMPRESSED_FORMATS:
+            return snapshot_response(
+                request,
+                name,
+                content_type,
+                stamp,
+                last_modified,
+                filename,
+                content_encoding=None,
+            )
+        if compression:
+            return snapshot_response(
+                request,
+                name,
+                COMPRESSIONS["gzip"][2],
+                stamp,
+                last_modified,
+                f"{export_filename(collection, _format)}.gz",
+                content_encoding=None,
+            )
+        return snapshot_response(
+            request, name, content_type, stamp, last_modified, filename
         )
-        writer = csv.writer(response)
-        add_csv_data(writer, collection, request)
-    else:
-        response = JsonResponse(add_json_data(collection, request), safe=False)
+    chunks = stream_export_data(collection, request.GET, _format)
+    content_encoding = None
+    if compression:
+        compressor, extension, content_type = COMPRESSIONS[compression]
+        filename = f"{export_filename(collection, _format)}.{extension}"
+        chunks = compressor(chunks)
+    elif _format not in COMPRESSED_FORMATS and (
+        content_encoding := negotiate_compression(encodings)
+    ):
+        chunks = COMPRESSIONS[content_encoding][0](chunks)
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    if content_encoding:
+        response["Content-Encoding"] = content_encoding
+    response["Vary"] = "Accept-Encoding"
+    if filename:
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
     return response